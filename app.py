@@ -1,8 +1,10 @@
 import os
+import pandas as pd
 import streamlit as st
 from streamlit import session_state as ss
 
-from model.utils import save_jsonl, build_horse_dict, read_jsonl, clean_sire_horse_df, clean_race_df, read_horse_raw_data
+from model.utils import save_jsonl, build_horse_dict, read_jsonl, clean_sire_horse_df, clean_race_df, read_horse_raw_data, load_manifest, build_horse_dict_from_manifest
+from model.analysis import SireCube, FilterIndex, ANALYSIS_GROUPINGS, RANKED_ANALYSES, RANK_BY_CHOICES, rank_group_values
 from model.widget import scraping_and_save_data, st_hire_horse_birth_year, show_prize_money_histogram, race_record_ratio_chart, extract_sire_id
 import model.widget as st_widget
 
@@ -13,18 +15,36 @@ tab_scraping, tab_analysis = st.tabs(["Data Scraping", "Data Analysis"])
 
 refresh_btn = st.sidebar.button("Refresh")
 
+DATA_ROOT = "s3://keiba-blood-analyzer-storage/data"
+
 # キャッシュデータ
 # 読み込み済みの種牡馬一覧データを読み込み
-@st.cache_data(ttl=600)  # ttlで秒ごとにキャッシュをリセット
-def load_sire_horse_dict():
+# マニフェストのversionをキーにキャッシュし、versionが変わった時だけ作り直す
+@st.cache_data
+def load_sire_horse_dict(manifest_version: int, _manifest: dict):
+    if _manifest["sires"]:
+        return build_horse_dict_from_manifest(_manifest, DATA_ROOT)
+    # マニフェストがまだない場合はディレクトリを走査する
     return build_horse_dict("data/")
 
-if refresh_btn:
-    load_sire_horse_dict.clear()
-    ss.sire_horse_dict = load_sire_horse_dict()
-
-if "sire_horse_dict" not in ss:
-    ss.sire_horse_dict = load_sire_horse_dict()
+# 種牡馬1頭分のデータと事前集計（集計キューブ・絞り込みの索引）
+# 種牡馬IDとマニフェストの更新日時をキーにプロセス内で1回だけ作り、全セッションで共有する
+@st.cache_resource(max_entries=16)
+def load_sire_analysis(sire_id: str, version: str | None, sire_horse_name: str, _sire_horse_dict: dict, _on_progress=None):
+    memory_report = {}
+    df_sire, df_race = read_horse_raw_data(
+        sire_horse_name, _sire_horse_dict, on_progress=_on_progress,
+        compact=True, memory_report=memory_report,
+    )
+    # 絞り込み条件・分析の切り口ごとの成績を事前集計しておく
+    return df_sire, df_race, SireCube(df_race, df_sire), FilterIndex(df_race, df_sire), memory_report
+
+if refresh_btn or "sire_horse_dict" not in ss:
+    manifest = load_manifest(DATA_ROOT)
+    if refresh_btn and manifest["version"] == 0:
+        load_sire_horse_dict.clear()
+        load_sire_analysis.clear()
+    ss.sire_horse_dict = load_sire_horse_dict(manifest["version"], manifest)
 
 
 # データのスクレイピング画面
@@ -42,8 +62,10 @@ with tab_scraping:
     if os.path.exists(f"data/{sire_id}/{sire_id}.jsonl"):
         st.info(f"既に{sire_id}のデータが存在します。上書きしてよい場合はボタンを押してください。")
 
+    incremental = st.checkbox("差分更新（取得済みの産駒は新しいレースのみ取得）", value=False)
+
     if st.button("Scrape Data", disabled=(not base_url or not sire_id)):
-        scraping_and_save_data(base_url, max_pages, sire_id)        
+        scraping_and_save_data(base_url, max_pages, sire_id, incremental=incremental)        
 
 with st.sidebar:
     # do_filter = st.button("フィルター")
@@ -53,35 +75,11 @@ with st.sidebar:
     c_field_cat = st.multiselect("競馬場", ("中央", "地方"), default=None)
     c_data_min = st.number_input("最低データ数", min_value=1, value=10, step=1)
     c_show_timediff_graph = st.toggle("着差グラフを表示", value=False)
+    c_show_timediff_points = st.toggle("着差グラフに全レースを送る（外れ値も表示・重い）", value=False,
+                                       disabled=not c_show_timediff_graph)
     with st.expander("産駒フィルター"):
         c_prize_money_range = st.slider("総賞金（百万円）", min_value=0, max_value=500, value=(0, 500), step=10)
 
-def filter_race_df(df_race, df_sire, c_dirt_turf, c_distance, c_condition, c_field_cat, c_prize_money_range):
-    min_prize, max_prize = c_prize_money_range[0], c_prize_money_range[1]
-    df_sire = df_sire[(df_sire["総賞金(万円)"] >= min_prize * 10**2) & (df_sire["総賞金(万円)"] <= max_prize * 10**2)]
-    sire_horse_names = df_sire["馬名"].tolist()
-    df_race = df_race[df_race["馬名"].isin(sire_horse_names)]
-
-    if c_dirt_turf != "両方":
-        df_race = df_race[df_race["芝ダート"] == {"芝":"芝", "ダート":"ダ"}[c_dirt_turf]]
-    if c_distance:
-        distance_mapping = {
-            "短距離": ["0800~1400"],
-            "マイル": ["1400~1800"],
-            "中距離": ["1800~2400"],
-            "長距離": ["2400~3000"]
-        }
-        allowed_distances = []
-        for dist_cat in c_distance:
-            allowed_distances.extend(distance_mapping.get(dist_cat, []))
-        df_race = df_race[df_race["距離区分"].isin(allowed_distances)]
-    if c_condition:
-        df_race = df_race[df_race["馬場"].isin(c_condition)]
-    if c_field_cat:
-        df_race = df_race[df_race["競馬場区分"].isin(c_field_cat)]
-    return df_race, df_sire
-
-
 # データの分析画面
 with tab_analysis:
 
@@ -97,23 +95,26 @@ with tab_analysis:
             else:
                 ss.selected_sire_horse_name = selected_sire_horse_name
                 with st.spinner("Loading data..."):
-                    ss.df_sire_raw, ss.df_race_raw = read_horse_raw_data(selected_sire_horse_name, ss.sire_horse_dict)
+                    load_progress = st.progress(0.0)
+                    sire_entry = ss.sire_horse_dict[selected_sire_horse_name]
+                    ss.df_sire_raw, ss.df_race_raw, ss.sire_cube, ss.filter_index, ss.memory_report = load_sire_analysis(
+                        sire_entry["horse_id"], sire_entry.get("version"), selected_sire_horse_name, ss.sire_horse_dict,
+                        _on_progress=lambda done, total: load_progress.progress(done / total, text=f"レースデータ読み込み中 {done}/{total}"),
+                    )
+                    load_progress.empty()
         
+        # 読み込んだデータのメモリ使用量（段階ごと）
+        if ss.get("memory_report"):
+            with st.sidebar.expander("メモリ使用量"):
+                st.dataframe((pd.DataFrame(ss.memory_report).T / 1024**2).round(1).add_suffix("(MB)"))
+
         # サイドバーの条件をキーとして保持
         filter_key = (c_dirt_turf, tuple(c_distance) if c_distance else (), 
                      tuple(c_condition) if c_condition else (), tuple(c_field_cat) if c_field_cat else (),
                      c_prize_money_range)
         
-        # フィルター条件が変更された時のみfilter_race_dfを実行
-        if "filter_key" not in ss or ss.filter_key != filter_key:
-            ss.filter_key = filter_key
-            df_race, df_sire = filter_race_df(ss.df_race_raw.copy(), ss.df_sire_raw.copy(), 
-                                    c_dirt_turf, c_distance, c_condition, c_field_cat,
-                                    c_prize_money_range)
-        else:
-            df_race, df_sire = filter_race_df(ss.df_race_raw.copy(), ss.df_sire_raw.copy(), 
-                                    c_dirt_turf, c_distance, c_condition, c_field_cat,
-                                    c_prize_money_range)
+        # 値ごとのビットマップで絞り込む（条件ごとに該当行の位置を覚えておき、該当行だけを取り出す）
+        df_race, df_sire = ss.filter_index.filter(filter_key)
 
 
         options_analysis = [
@@ -152,43 +153,47 @@ with tab_analysis:
                                 )
             
             def show_graph(df_race, analysis_name, c_data_min, c_show_timediff_graph):
-                # 距離ごとでの戦績
-                if analysis_name == "距離":
-                    groupby_cols = ["距離区分", "芝ダート"]
-
-                # 競馬場ごとでの戦績
-                elif analysis_name == "競馬場":
-                    groupby_cols = ["競馬場", "芝ダート"]
-
-                # 季節ごとでの戦績
-                elif analysis_name == "季節":
-                    groupby_cols = ["季節", "芝ダート", "距離区分"]
-
-                # カーブごとでの戦績
-                elif analysis_name == "カーブ":
-                    groupby_cols = ["カーブ", "芝ダート", "距離区分"]
-
-                # 芝ダートごとでの戦績
-                elif analysis_name == "芝ダート":
-                    groupby_cols = ["芝ダート", "馬場"]
-
-                # 騎手ごとでの戦績
-                elif analysis_name == "騎手":
-                    groupby_cols = ["騎手", "距離区分"]
-                
-                # 馬場ごとでの戦績
-                elif analysis_name == "馬場":
-                    groupby_cols = ["馬場", "芝ダート", "距離区分"]
-
-                # クラスごとでの戦績
-                elif analysis_name == "クラス":
-                    groupby_cols = ["クラス", "芝ダート"]
-
-                if analysis_name and analysis_name != "産駒":
+                # 分析の種類ごとの集計の切り口（距離・競馬場・季節・カーブ・芝ダート・騎手・馬場・クラス）
+                groupby_cols = ANALYSIS_GROUPINGS.get(analysis_name)
+
+                if groupby_cols:
+                    # 騎手・競馬場は値が多いため、上位 top_k 件ずつページ送りで表示する（残りは「その他」）
+                    rank_options = {}
+                    if analysis_name in RANKED_ANALYSES:
+                        col_rank_by, col_top_k, col_page = st.columns(3)
+                        rank_options = dict(
+                            rank_by=col_rank_by.radio("並び順", list(RANK_BY_CHOICES), horizontal=True),
+                            top_k=col_top_k.number_input("表示件数", min_value=5, max_value=100, value=20, step=5),
+                            page=col_page.number_input("ページ", min_value=1, value=1, step=1) - 1,
+                        )
+
+                    def compute_stats():
+                        return ss.sire_cube.stats(groupby_cols, c_dirt_turf, c_distance, c_condition,
+                                                  c_field_cat, c_prize_money_range)
+
+                    def show_page_caption(pages):
+                        if rank_options and pages > 1:
+                            page = min(rank_options["page"] + 1, pages)
+                            st.caption(f"{page} / {pages} ページ（{rank_options['rank_by']}順、表示しない{groupby_cols[0]}は「その他」にまとめています）")
+
                     if c_show_timediff_graph:
-                        st_widget.race_margin_timediff_chart(df_race, groupby_cols, data_min=c_data_min)
+                        # 着差グラフも成績と同じ順位で先頭の列の値を選ぶ
+                        group_values, pages = None, 1
+                        if rank_options:
+                            group_values, pages = rank_group_values(compute_stats(), groupby_cols, c_data_min, **rank_options)
+                        show_page_caption(pages)
+                        st_widget.race_margin_timediff_chart(df_race, groupby_cols, data_min=c_data_min,
+                                                             show_points=c_show_timediff_points,
+                                                             group_values=group_values)
                     else:
-                        st_widget.race_record_ratio_chart(df_race, groupby_cols,data_min=c_data_min)
+                        # 同じ種牡馬・条件・切り口の表はプロセス内で使い回し、なければ事前集計から足し上げる
+                        sire_key = (ss.selected_sire_horse_name, ss.df_race_raw.attrs.get("source_fingerprint"))
+                        table = st_widget.cached_race_record_table(
+                            (sire_key, filter_key), groupby_cols, c_data_min, compute_stats, **rank_options,
+                        )
+                        show_page_caption(table[0].attrs.get("pages", 1))
+                        st_widget.race_record_ratio_chart(df_race, groupby_cols, data_min=c_data_min, table=table,
+                                                          sort_conditions=not rank_options)
                     
                     # st.dataframe(df_race)
 
@@ -0,0 +1,109 @@
+"""
+clean_race_df のベンチマーク
+
+合成したレースデータ（欠損・未知の競馬場などを含む）を、以前の行ごとの apply による実装と
+列単位の現在の実装の両方でクリーニングし、出力が完全に一致することを確認したうえで処理時間を表示する
+
+    python -m benchmarks.clean_race_df [--rows 100000 400000] [--repeat 3] [--seed 0]
+"""
+import argparse
+import random
+import time
+
+import pandas as pd
+
+from model.utils import categorize_race_tier, clean_race_df, get_field_info, judge_distance_category
+
+
+def clean_race_df_apply(df, field_info):
+    """以前の実装（行ごとに apply する）。出力の比較用"""
+    df.rename(columns=lambda x: x.replace(" ", ""), inplace=True)
+    df['芝ダート'] = df['距離'].apply(lambda x: x[0] if isinstance(x, str) and (x[0] == '芝' or x[0] == 'ダ') else None)
+    df['距離_m'] = df['距離'].apply(lambda x: pd.to_numeric(x[1:], errors='coerce') if isinstance(x, str) else None)
+    df['距離区分'] = df['距離_m'].apply(lambda x: judge_distance_category(x) if pd.notnull(x) else None)
+    df['クラス'] = df['レース名'].apply(lambda x: categorize_race_tier(x))
+
+    field_names = list(field_info['地方'].keys()) + list(field_info['中央'].keys())
+    df['競馬場'] = df['開催'].apply(lambda x: next((name for name in field_names if isinstance(x, str) and name in x), None))
+    df['競馬場区分'] = df['競馬場'].apply(lambda x: '地方' if x in field_info['地方'] else ('中央' if x in field_info['中央'] else None))
+    df['カーブ'] = df['競馬場'].apply(lambda x: field_info['地方'].get(x) if x in field_info['地方'] else (field_info['中央'].get(x) if x in field_info['中央'] else None))
+
+    df['月'] = df['日付'].apply(lambda x: int(x.split('/')[1]) if isinstance(x, str) else None)
+    df['季節'] = df['月'].apply(lambda x: '04~06春' if x in [4,5,6] else ('07~09夏' if x in [7,8,9] else ('10~12秋' if x in [10,11,12] else ('01~03冬' if x in [1,2,3] else None))))
+
+    for num_col in ['R', '頭数', '枠番', '馬番', 'オッズ', '人気', '着順',
+       '斤量', '着差','上り', '距離_m']:
+        df[num_col] = pd.to_numeric(df[num_col], errors='coerce')
+
+    df['1着'] = df['着順'] == 1
+    df['2着'] = df['着順'] <= 2
+    df['3着'] = df['着順'] <= 3
+    df['掲示板'] = df['着順'] <= 5
+    return df
+
+
+RACE_NAMES = ["有馬記念(GI)", "阪神大賞典(GII)", "小倉2歳S(GIII)", "3歳未勝利", "2歳新馬", "1勝クラス",
+              "2勝クラス", "3勝クラス", "リステッドL", "C1一", "500万下", "スプリングS", "東京ダービーJpn1"]
+
+
+def make_races(rows: int, field_info: dict, seed: int, with_missing: bool) -> pd.DataFrame:
+    rng = random.Random(seed)
+    tracks = list(field_info['中央']) + list(field_info['地方']) + ["ロンシャン", "シャティン"]
+
+    def maybe(value):
+        return None if with_missing and rng.random() < 0.02 else value
+
+    data = {
+        "日付": [maybe(f"20{rng.randint(10, 24)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}") for _ in range(rows)],
+        "開催": [maybe(f"{rng.randint(1, 5)}{rng.choice(tracks)}{rng.randint(1, 12)}") for _ in range(rows)],
+        "レース名": [maybe(rng.choice(RACE_NAMES)) for _ in range(rows)],
+        "距離": [maybe(f"{rng.choice(['芝', 'ダ', '障'])}{rng.choice([1000, 1200, 1400, 1600, 1800, 2000, 2400, 3000, 3600])}")
+                 for _ in range(rows)],
+        "馬場": [maybe(rng.choice(["良", "稍", "重", "不"])) for _ in range(rows)],
+    }
+    for col in ['R', '頭数', '枠番', '馬番', 'オッズ', '人気', '着順', '斤量', '着差', '上り']:
+        data[col] = [maybe(str(rng.randint(1, 18))) for _ in range(rows)]
+    return pd.DataFrame(data)
+
+
+def normalize_string_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """文字列の列を object 型にそろえる（pandas 3 では列単位の文字列処理の結果が string 型になるため）"""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col]) and not pd.api.types.is_object_dtype(df[col]):
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
+
+def bench(func, df: pd.DataFrame, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        work = df.copy()
+        start = time.perf_counter()
+        result = func(work)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, nargs="+", default=[100_000, 400_000])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    field_info = get_field_info()
+    for rows in args.rows:
+        for with_missing in (False, True):
+            df = make_races(rows, field_info, args.seed, with_missing)
+            expected, elapsed_apply = bench(lambda d: clean_race_df_apply(d, field_info), df, args.repeat)
+            actual, elapsed = bench(lambda d: clean_race_df(d, field_info), df, args.repeat)
+            # 列の並び・型（文字列の列は object 型にそろえる）・値（Noneの位置を含む）まで一致すること
+            pd.testing.assert_frame_equal(normalize_string_dtypes(actual), normalize_string_dtypes(expected))
+            label = "欠損あり" if with_missing else "欠損なし"
+            print(f"rows={rows:>8} {label} apply={elapsed_apply:8.3f}s vectorized={elapsed:8.3f}s "
+                  f"x{elapsed_apply / elapsed:6.1f}")
+
+
+if __name__ == "__main__":
+    main()
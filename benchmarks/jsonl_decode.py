@@ -0,0 +1,101 @@
+"""
+JSONLのデコード（レースファイル読み込みのJSON部分）のベンチマーク
+
+合成したレースファイルのbytesを、以前の読み込み方（全体をstrにデコードして分割し、1行ずつ json.loads した後で
+fetch_text_from_rawdata で text を取り出す）と、parse_text_records（stdlib / orjson）で処理し、
+結果が一致することを確認したうえで rows/sec を表示する
+
+    python -m benchmarks.jsonl_decode [--rows 200000] [--repeat 3]
+"""
+import argparse
+import json
+import time
+
+import model.utils as utils
+
+COLUMNS = ["日付", "開催", "天気", "R", "レース名", "映像", "頭数", "枠番", "馬番", "オッズ", "人気", "着順",
+           "騎手", "斤量", "距離", "馬場", "馬場指数", "タイム", "着差", "ﾀｲﾑ指数", "通過", "ペース", "上り",
+           "馬体重", "厩舎ｺﾒﾝﾄ", "備考", "勝ち馬(2着馬)", "賞金"]
+
+
+def make_content(rows: int) -> bytes:
+    lines = []
+    for i in range(rows):
+        raw = {col: {"text": f"{col}{i % 97}", "href": f"/race/{i}/" if col == "レース名" else None} for col in COLUMNS}
+        raw["映像"] = {"text": ""}
+        raw["着順 ↑ ↓"] = raw.pop("着順")
+        lines.append(json.dumps({"_raw": raw}, ensure_ascii=False))
+    return "\n".join(lines).encode("utf-8")
+
+
+def fetch_text_from_rawdata_legacy(result):
+    """以前の fetch_text_from_rawdata"""
+    data = []
+    for raw in result:
+        raw_data = {}
+        for key, value in raw['_raw'].items():
+            if ' ↑ ↓' in key:
+                key = key.replace(' ↑ ↓', '').replace(' ', '').strip()
+            if isinstance(value, dict):
+                if 'text' in value:
+                    text = value['text']
+                    if text != '':
+                        raw_data[key] = text
+        data.append(raw_data)
+    return data
+
+
+def legacy(content: bytes):
+    """以前の読み込み方"""
+    data = []
+    for line in content.decode("utf-8").strip().split("\n"):
+        if line:
+            data.append(json.loads(line))
+    return fetch_text_from_rawdata_legacy(data)
+
+
+def fast_path(loads):
+    def _run(content: bytes):
+        utils._json_loads = loads
+        return list(utils.parse_text_records(line for line in content.splitlines() if line.strip()))
+    return _run
+
+
+def bench(func, content: bytes, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(content)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    content = make_content(args.rows)
+    candidates = {"legacy": legacy, "stdlib": fast_path(json.loads)}
+    try:
+        import orjson
+        candidates["orjson"] = fast_path(orjson.loads)
+    except ImportError:
+        print("orjson がインストールされていないため、stdlib のみ計測します")
+
+    original_loads = utils._json_loads
+    try:
+        expected, base = bench(legacy, content, args.repeat)
+        for name, func in candidates.items():
+            result, elapsed = bench(func, content, args.repeat)
+            if result != expected:
+                raise SystemExit(f"{name}: 以前の読み込み方と結果が一致しません")
+            print(f"{name:<7} rows={args.rows:>8} {elapsed:8.3f}s {args.rows / elapsed:10.0f} rows/sec "
+                  f"x{base / elapsed:5.1f}")
+    finally:
+        utils._json_loads = original_loads
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+レースデータ読み込み(load_sire_raw_frames)のベンチマーク
+
+産駒数を変えた合成データ（ローカルのJSONL）を作り、産駒数に対して読み込み時間が線形に増えることを確認する
+比較用に、以前の「1ファイル読むたびに pd.concat で結合する」読み込み方も計測する
+
+    python -m benchmarks.load_races [--horses 100 200 400 800 1600] [--races 30] [--repeat 3]
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from model.utils import load_sire_raw_frames, read_jsonl, sire_data_paths
+
+COLUMNS = ["日付", "開催", "天気", "R", "レース名", "頭数", "枠番", "馬番", "オッズ", "人気",
+           "着順", "騎手", "斤量", "距離", "馬場", "タイム", "着差", "上り", "馬体重"]
+
+
+def make_dataset(base_dir: Path, sire_id: str, horses: int, races: int) -> dict:
+    """産駒 horses 頭・1頭あたり races レースの合成データを保存し、そのパスを返す"""
+    races_dir = base_dir / "races"
+    races_dir.mkdir(parents=True)
+    horse_names = {}
+    sire_rows = []
+    for i in range(horses):
+        horse_id = f"{2015000000 + i}"
+        horse_names[horse_id] = f"テスト馬{i}"
+        sire_rows.append({"horse_id": horse_id, "_raw": {"馬名": {"text": horse_names[horse_id]}}})
+        with open(races_dir / f"{horse_id}.jsonl", "w", encoding="utf-8") as f:
+            for r in range(races):
+                raw = {col: {"text": f"{col}{r}"} for col in COLUMNS}
+                raw["着順"] = {"text": str(r % 12 + 1)}
+                f.write(json.dumps({"_raw": raw}, ensure_ascii=False) + "\n")
+    with open(races_dir / "horse_names.json", "w", encoding="utf-8") as f:
+        json.dump(horse_names, f, ensure_ascii=False)
+    with open(base_dir / f"{sire_id}.jsonl", "w", encoding="utf-8") as f:
+        f.write("\n".join(json.dumps(row, ensure_ascii=False) for row in sire_rows))
+    return sire_data_paths(str(base_dir), sire_id)
+
+
+def load_with_concat(paths: dict) -> pd.DataFrame:
+    """以前の読み込み方（ファイルごとにDataFrameを作り、その都度これまでの結果と結合する）"""
+    with open(paths["race_horse_names"], "r", encoding="utf-8") as f:
+        race_horse_names = json.load(f)
+    df_race = pd.DataFrame()
+    for race_file in sorted(Path(paths["races_dir"]).glob("*.jsonl")):
+        df = read_jsonl(str(race_file)).assign(馬名=race_horse_names.get(race_file.stem, race_file.stem))
+        df_race = pd.concat([df_race, df], axis=0, ignore_index=True)
+    return df_race
+
+
+def bench(func, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--horses", type=int, nargs="+", default=[100, 200, 400, 800, 1600])
+    ap.add_argument("--races", type=int, default=30, help="1頭あたりのレース数")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    print(f"{'horses':>7} {'rows':>8} {'single-pass':>12} {'us/row':>7} {'concat':>9} {'us/row':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for horses in args.horses:
+            paths = make_dataset(Path(tmp) / str(horses), "sire", horses, args.races)
+            (_, df_race), elapsed = bench(lambda: load_sire_raw_frames(paths), args.repeat)
+            df_concat, elapsed_concat = bench(lambda: load_with_concat(paths), args.repeat)
+            if len(df_race) != len(df_concat):
+                raise SystemExit("読み込んだ行数が一致しません")
+            rows = len(df_race)
+            print(f"{horses:>7} {rows:>8} {elapsed:11.3f}s {elapsed / rows * 1e6:7.2f} "
+                  f"{elapsed_concat:8.3f}s {elapsed_concat / rows * 1e6:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+margin_box_summary（着差の箱ひげ図の要約）のベンチマーク
+
+合成したレースデータで、条件ごとに numpy で計算した四分位数・ひげの端と一致することを確認したうえで処理時間を表示する
+着差が数値のレースがない場合・全ての条件が最低データ数未満の場合に、空の要約を返すことも確認する
+
+    python -m benchmarks.margin_box_summary [--rows 100000 400000] [--repeat 3] [--seed 0]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from model.widget import margin_box_summary
+
+GROUPBY_COLS = ["距離区分", "芝ダート"]
+
+
+def make_races(rows: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    margins = rng.normal(0.8, 0.7, rows).round(1).astype(str)
+    margins[rng.random(rows) < 0.05] = "ハナ"
+    return pd.DataFrame({
+        "距離区分": rng.choice(["0800~1400", "1400~1800", "1800~2400", "2400~3000"], rows),
+        "芝ダート": rng.choice(["芝", "ダ", None], rows, p=[0.5, 0.45, 0.05]),
+        "着差": margins,
+    })
+
+
+def expected_summary(df: pd.DataFrame, data_min: int) -> pd.DataFrame:
+    """条件ごとに numpy で計算した要約（比較用）"""
+    df = df[df["芝ダート"].notna()].assign(着差_数値=pd.to_numeric(df["着差"], errors="coerce")).dropna(subset=["着差_数値"])
+    rows = {}
+    for condition, values in df.groupby(df["距離区分"] + "/" + df["芝ダート"])["着差_数値"]:
+        values = values.to_numpy()
+        if len(values) < data_min:
+            continue
+        q1, median, q3 = np.percentile(values, [25, 50, 75])
+        iqr = q3 - q1
+        rows[condition] = {
+            "件数": len(values), "q1": q1, "median": median, "q3": q3,
+            "lowerfence": values[values >= q1 - 1.5 * iqr].min(),
+            "upperfence": values[values <= q3 + 1.5 * iqr].max(),
+        }
+    return pd.DataFrame.from_dict(rows, orient="index").rename_axis("条件").sort_index()
+
+
+def check_empty_cases():
+    # 着差が数値のレースがない
+    df = pd.DataFrame({"距離区分": ["1400~1800"] * 3, "芝ダート": ["芝"] * 3, "着差": ["ハナ", None, "クビ"]})
+    if not margin_box_summary(df, GROUPBY_COLS, data_min=1).empty:
+        raise SystemExit("着差が数値のレースがない場合に空の要約になりません")
+    # 全ての条件が最低データ数未満
+    df = make_races(100, 0)
+    if not margin_box_summary(df, GROUPBY_COLS, data_min=1000).empty:
+        raise SystemExit("全ての条件が最低データ数未満の場合に空の要約になりません")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, nargs="+", default=[100_000, 400_000])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--data-min", type=int, default=10)
+    args = ap.parse_args()
+
+    check_empty_cases()
+    for rows in args.rows:
+        df = make_races(rows, args.seed)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            summary = margin_box_summary(df, GROUPBY_COLS, args.data_min)
+            best = min(best, time.perf_counter() - start)
+        pd.testing.assert_frame_equal(summary, expected_summary(df, args.data_min), check_dtype=False)
+        print(f"rows={rows:>8} conditions={len(summary):>3} {best:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
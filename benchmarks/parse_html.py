@@ -0,0 +1,67 @@
+"""
+HTMLテーブルパーサーのベンチマーク
+
+保存済みのHTML（産駒一覧ページ・競走戦績ページ）を bs4 と lxml の両方でパースし、
+出力が一致することを確認したうえで rows/sec を表示する
+
+    python -m benchmarks.parse_html [HTMLファイルまたはディレクトリ ...] [--repeat N]
+
+引数を省略した場合は HtmlCache の保存先(cache/html)にあるページを使う
+"""
+import argparse
+import time
+from pathlib import Path
+
+from model.scraping import parse_html, parse_netkeiba_horse_list_table
+
+TABLES = {
+    "sire_list": "競走馬検索結果",
+    "race_result": "の競走戦績",
+}
+
+
+def load_fixtures(paths):
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("**/*.html")) if path.is_dir() else [path])
+    return [f.read_bytes().decode("euc-jp", "ignore") for f in files]
+
+
+def bench(pages, parser: str, table_summary_desc: str, repeat: int):
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            doc = parse_html(html, parser=parser)
+            rows += len(parse_netkeiba_horse_list_table(doc, table_summary_desc=table_summary_desc, parser=parser))
+    return rows, time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("paths", nargs="*", default=["cache/html"])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    htmls = load_fixtures(args.paths)
+    for table_name, desc in TABLES.items():
+        # 対象テーブルを含むページだけを使う
+        pages = [h for h in htmls if desc in h]
+        if not pages:
+            print(f"{table_name}: 対象のHTMLがありません")
+            continue
+
+        for html in pages:
+            expected = parse_netkeiba_horse_list_table(parse_html(html, "bs4"), table_summary_desc=desc)
+            actual = parse_netkeiba_horse_list_table(parse_html(html, "lxml"), table_summary_desc=desc, parser="lxml")
+            if expected != actual:
+                raise SystemExit(f"{table_name}: bs4 と lxml の出力が一致しません")
+
+        for parser in ("bs4", "lxml"):
+            rows, elapsed = bench(pages, parser, desc, args.repeat)
+            print(f"{table_name:<12} {parser:<5} pages={len(pages):>5} rows={rows:>7} "
+                  f"{elapsed:8.3f}s {rows / elapsed:10.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+ブラウザを使わずに複数の種牡馬のデータをまとめて取得するコマンド
+
+    python crawl.py 000a00033a 000a000e0a --processes 4
+    python crawl.py --sire-file sires.txt --incremental
+    python crawl.py 000a00033a --compact-only
+    python crawl.py --rebuild-manifest
+
+種牡馬ごとに別プロセスで取得し、保存先は Streamlit の「Scrape Data」と同じ data/{sire_id}/ の構成になる
+--rate は全プロセス合計のリクエスト数/秒で、各プロセスには均等に割り振られる
+（デフォルトは以前の逐次取得と同じ程度の0.35。サイトの負担になるため、上げる場合は必要な分だけにする）
+--rebuild-manifest は、マニフェストができる前に保存した種牡馬をマニフェストに追加する（一覧に表示されない種牡馬がある場合に1回実行する）
+"""
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from model.crawler import compact_sire, scrape_sire, sire_output_dir
+from model.scraping import DEFAULT_BURST, DEFAULT_RATE, RateLimiter
+from model.utils import rebuild_manifest
+
+# 各ワーカープロセスで共有するレートリミッタ（initializerで設定する）
+_rate_limiter = None
+
+
+def _init_worker(rate: float, capacity: float) -> None:
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rate=rate, capacity=capacity)
+
+
+def _crawl_one(sire_id: str, args: argparse.Namespace) -> bool:
+    output_dir = sire_output_dir(sire_id, use_local=args.local, s3_bucket=args.bucket, s3_prefix=args.prefix)
+
+    def _on_progress(fraction: float, text: str) -> None:
+        print(f"[{sire_id}] [{fraction:6.1%}] {text}", flush=True)
+
+    def _log(text: str) -> None:
+        print(f"[{sire_id}] {text}", flush=True)
+
+    if args.compact_only:
+        compact_sire(sire_id, output_dir, log=_log)
+        return True
+
+    return scrape_sire(
+        sire_id, output_dir, max_pages=args.max_pages, incremental=args.incremental,
+        max_workers=args.workers, rate_limiter=_rate_limiter, parser=args.parser,
+        on_sire_progress=_on_progress, on_race_progress=_on_progress, log=_log,
+    )
+
+
+def _read_sire_ids(args: argparse.Namespace) -> list:
+    sire_ids = list(args.sire_ids)
+    if args.sire_file:
+        with open(args.sire_file, "r", encoding="utf-8") as f:
+            sire_ids += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    # 重複を除いて指定順を保つ
+    return list(dict.fromkeys(sire_ids))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("sire_ids", nargs="*", help="取得する種牡馬のsire_id")
+    ap.add_argument("--sire-file", help="sire_idを1行に1つ書いたファイル（#で始まる行は無視）")
+    ap.add_argument("--processes", type=int, default=2, help="同時に取得する種牡馬の数")
+    ap.add_argument("--workers", type=int, default=4, help="種牡馬ごとの同時リクエスト数")
+    ap.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                    help="全プロセス合計のリクエスト数/秒（デフォルトは以前の逐次取得と同じ程度）")
+    ap.add_argument("--burst", type=float, default=DEFAULT_BURST, help="全プロセス合計の最大バースト数")
+    ap.add_argument("--max-pages", type=int, default=30, help="産駒リストの最大ページ数")
+    ap.add_argument("--incremental", action="store_true", help="取得済みの産駒は新しいレースのみ取得する")
+    ap.add_argument("--compact-only", action="store_true", help="取得はせず、保存済みのJSONLからParquetだけを作り直す")
+    ap.add_argument("--rebuild-manifest", action="store_true",
+                    help="保存先を走査して、マニフェストにない保存済みの種牡馬を追加する（sire_idは不要）")
+    ap.add_argument("--parser", choices=["bs4", "lxml"], default="bs4")
+    ap.add_argument("--local", action="store_true", help="S3ではなくローカルの data/ に保存する")
+    ap.add_argument("--bucket", default="keiba-blood-analyzer-storage")
+    ap.add_argument("--prefix", default="data")
+    args = ap.parse_args(argv)
+
+    if args.rebuild_manifest:
+        data_root = sire_output_dir("", use_local=args.local, s3_bucket=args.bucket, s3_prefix=args.prefix).rstrip('/')
+        added = rebuild_manifest(data_root)
+        print(f"マニフェストに{added}頭を追加しました: {data_root}")
+        return 0
+
+    sire_ids = _read_sire_ids(args)
+    if not sire_ids:
+        ap.error("sire_idを指定してください")
+
+    processes = max(1, min(args.processes, len(sire_ids)))
+    # 全体の上限をプロセス数で割り、合計が --rate を超えないようにする
+    initargs = (args.rate / processes, max(1.0, args.burst / processes))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=initargs) as executor:
+        futures = {executor.submit(_crawl_one, sire_id, args): sire_id for sire_id in sire_ids}
+        for future in as_completed(futures):
+            sire_id = futures[future]
+            try:
+                saved = future.result()
+            except Exception as e:
+                print(f"[{sire_id}] 取得中にエラーが発生しました: {e}", file=sys.stderr)
+                saved = False
+            if not saved:
+                failed.append(sire_id)
+
+    print(f"完了: {len(sire_ids) - len(failed)}/{len(sire_ids)} 頭")
+    if failed:
+        print(f"失敗: {' '.join(failed)}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+種牡馬1頭分の成績を、サイドバーの絞り込み条件 × 分析の切り口ごとに事前集計しておく集計キューブ
+
+読み込み時に1回だけ、絞り込みの次元(芝ダート・距離区分・馬場・競馬場区分・総賞金の区分)と
+分析の切り口(show_graph の groupby_cols)ごとに着順別の件数を集計しておき、
+条件を変えたときは件数の足し上げ(roll-up)だけで race_record_stats と同じ結果を返す
+"""
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from model.utils import RACE_RECORD_COUNT_COLUMNS, add_race_record_rates, race_record_counts
+
+# 分析の種類ごとの集計の切り口（app.py の show_graph と同じ）
+ANALYSIS_GROUPINGS: Dict[str, List[str]] = {
+    "距離": ["距離区分", "芝ダート"],
+    "競馬場": ["競馬場", "芝ダート"],
+    "季節": ["季節", "芝ダート", "距離区分"],
+    "カーブ": ["カーブ", "芝ダート", "距離区分"],
+    "芝ダート": ["芝ダート", "馬場"],
+    "騎手": ["騎手", "距離区分"],
+    "馬場": ["馬場", "芝ダート", "距離区分"],
+    "クラス": ["クラス", "芝ダート"],
+}
+
+# 切り口の先頭の列（騎手・競馬場）の値が多いため、上位だけを表示してページ送りする分析
+RANKED_ANALYSES = ["競馬場", "騎手"]
+# 上位を決める並び順と、その並び順に使う列
+RANK_BY_CHOICES = {"出走数": "総出走数", "勝率": "勝率"}
+# 表示するページ以外の値をまとめた行の名前
+OTHERS_LABEL = "その他"
+
+# サイドバーの選択肢とデータの値の対応
+DIRT_TURF_CHOICES = {"芝": "芝", "ダート": "ダ"}
+DISTANCE_CHOICES = {
+    "短距離": ["0800~1400"],
+    "マイル": ["1400~1800"],
+    "中距離": ["1800~2400"],
+    "長距離": ["2400~3000"],
+}
+
+# 絞り込みの次元（総賞金は区分と区分の境界ちょうどかどうかで持つ）
+FILTER_DIMENSIONS = ["芝ダート", "距離区分", "馬場", "競馬場区分"]
+PRIZE_BUCKET = "賞金区分"
+PRIZE_EXACT = "賞金区分ちょうど"
+# 総賞金スライダーの刻み(10百万円)を万円にしたもの
+PRIZE_BUCKET_SIZE = 1000
+
+
+class SireCube:
+    """
+    種牡馬1頭分の集計キューブ
+
+    Args:
+        df_race: clean_race_df 後のレースデータ
+        df_sire: clean_sire_horse_df 後の産駒リスト（総賞金の絞り込みに使う）
+        groupings: 事前集計する切り口（省略時は ANALYSIS_GROUPINGS の全て）
+    """
+
+    def __init__(self, df_race: pd.DataFrame, df_sire: pd.DataFrame,
+                 groupings: List[List[str]] | None = None):
+        groupings = groupings if groupings is not None else list(ANALYSIS_GROUPINGS.values())
+
+        # 産駒の総賞金を区分に分ける（レースと産駒は馬名で対応づける）
+        prize = df_sire.drop_duplicates("馬名").set_index("馬名")["総賞金(万円)"]
+        race_prize = df_race["馬名"].map(prize).astype("float64")
+        base = pd.DataFrame({col: df_race[col] for col in FILTER_DIMENSIONS}, index=df_race.index)
+        base[PRIZE_BUCKET] = np.floor(race_prize / PRIZE_BUCKET_SIZE)
+        base[PRIZE_EXACT] = (race_prize % PRIZE_BUCKET_SIZE) == 0
+        counts = race_record_counts(df_race)
+
+        # 総賞金がない（産駒リストにいない・欠損）レースは、どの総賞金の範囲でも絞り込まれるため除く
+        has_prize = race_prize.notna()
+        self._cubes: Dict[Tuple[str, ...], pd.DataFrame] = {}
+        for groupby_cols in groupings:
+            key = tuple(groupby_cols)
+            if key in self._cubes:
+                continue
+            dims = FILTER_DIMENSIONS + [PRIZE_BUCKET, PRIZE_EXACT] + [col for col in groupby_cols if col not in FILTER_DIMENSIONS]
+            frame = base.join(df_race[[col for col in dims if col not in base.columns]]).join(counts)[has_prize]
+            # 絞り込みの次元の欠損は「条件を指定しない場合だけ含まれる」値として残す
+            self._cubes[key] = (
+                frame.groupby(dims, dropna=False, observed=True)[RACE_RECORD_COUNT_COLUMNS]
+                .sum()
+                .reset_index()
+            )
+
+    def stats(
+        self,
+        groupby_cols: List[str],
+        c_dirt_turf: str = "両方",
+        c_distance: List[str] | None = None,
+        c_condition: List[str] | None = None,
+        c_field_cat: List[str] | None = None,
+        c_prize_money_range: Tuple[int, int] = (0, 500),
+        ) -> pd.DataFrame:
+        """
+        サイドバーの条件で絞り込んだ成績を groupby_cols ごとに返す
+        （FilterIndex.filter で絞り込んでから race_record_stats で集計した結果と同じ）
+
+        Args:
+            groupby_cols: 集計の切り口（事前集計した切り口のいずれか）
+            c_dirt_turf: 芝ダート（"両方" / "芝" / "ダート"）
+            c_distance, c_condition, c_field_cat: 距離区分・馬場・競馬場区分の選択（空の場合は絞り込まない）
+            c_prize_money_range: 総賞金の範囲（百万円）
+        """
+        cube = self._cubes[tuple(groupby_cols)]
+
+        # 総賞金: min <= 総賞金 <= max（区分の境界ちょうどの馬は上限の区分からも含める）
+        # スライダーの刻みが区分の幅と同じため、範囲の端は常に区分の境界になる
+        min_bucket = c_prize_money_range[0] * 10**2 / PRIZE_BUCKET_SIZE
+        max_bucket = c_prize_money_range[1] * 10**2 / PRIZE_BUCKET_SIZE
+        bucket = cube[PRIZE_BUCKET]
+        mask = (bucket >= np.ceil(min_bucket)) & (
+            (bucket < max_bucket) | ((bucket == max_bucket) & cube[PRIZE_EXACT])
+        )
+        if c_dirt_turf != "両方":
+            mask &= cube["芝ダート"] == DIRT_TURF_CHOICES[c_dirt_turf]
+        if c_distance:
+            allowed_distances = [d for dist_cat in c_distance for d in DISTANCE_CHOICES.get(dist_cat, [])]
+            mask &= cube["距離区分"].isin(allowed_distances)
+        if c_condition:
+            mask &= cube["馬場"].isin(c_condition)
+        if c_field_cat:
+            mask &= cube["競馬場区分"].isin(c_field_cat)
+        # race_record_stats と同じく芝ダートが欠損しているレースは集計しない
+        mask &= cube["芝ダート"].notna()
+
+        stats = (
+            cube[mask]
+            .groupby(groupby_cols, observed=True)[RACE_RECORD_COUNT_COLUMNS]
+            .sum()
+            .reset_index()
+        )
+        return add_race_record_rates(stats)
+
+
+class FilterIndex:
+    """
+    サイドバーの絞り込みを、値ごとに事前計算したビットマップの論理積で行う索引
+
+    芝ダート・距離区分・馬場・競馬場区分が選択に当てはまり、総賞金が範囲内の産駒のレースと、その産駒を残す
+    （距離区分・馬場・競馬場区分は何も選択しない場合は絞り込まない）
+
+    - 芝ダート・距離区分・馬場・競馬場区分は、値ごとのブール配列を選択された値でOR、列どうしでANDする
+    - 総賞金は産駒ごとに比較し、範囲内の産駒の馬名に当たるレースを馬名のコードで引く
+    - 条件(filter_key)ごとに、該当する行の位置を覚えておく（スライダーを戻したときは再計算しない）
+    結果は該当する行だけを取り出したDataFrameで、元のDataFrame全体はコピーしない
+
+    Args:
+        df_race: clean_race_df 後のレースデータ
+        df_sire: clean_sire_horse_df 後の産駒リスト
+        max_cached: 覚えておく条件の数
+    """
+
+    def __init__(self, df_race: pd.DataFrame, df_sire: pd.DataFrame, max_cached: int = 64):
+        self.df_race = df_race
+        self.df_sire = df_sire
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[tuple, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        # 複数のセッション（スレッド）で共有されるため、キャッシュの更新はロックして行う
+        self._cache_lock = threading.Lock()
+
+        # 値ごとのビットマップ
+        self._bitmaps: Dict[str, Dict[object, np.ndarray]] = {}
+        for col in FILTER_DIMENSIONS:
+            codes, uniques = pd.factorize(df_race[col])
+            self._bitmaps[col] = {value: codes == i for i, value in enumerate(uniques)}
+
+        # 馬名をコードにする（レースの馬名のうち産駒リストにないものは、末尾の常にFalseの位置を指す）
+        self._sire_prize = pd.to_numeric(df_sire["総賞金(万円)"], errors="coerce").to_numpy(dtype="float64")
+        sire_codes, sire_names = pd.factorize(df_sire["馬名"])
+        self._sire_name_codes = sire_codes
+        race_codes = pd.Index(sire_names).get_indexer(df_race["馬名"])
+        race_codes[race_codes < 0] = len(sire_names)
+        self._race_name_codes = race_codes
+        self._name_count = len(sire_names)
+
+    def _value_mask(self, col: str, values) -> np.ndarray:
+        bitmaps = self._bitmaps[col]
+        mask = np.zeros(len(self.df_race), dtype=bool)
+        for value in values:
+            if value in bitmaps:
+                mask |= bitmaps[value]
+        return mask
+
+    def _positions(self, filter_key: tuple) -> Tuple[np.ndarray, np.ndarray]:
+        c_dirt_turf, c_distance, c_condition, c_field_cat, c_prize_money_range = filter_key
+
+        # 総賞金の範囲内の産駒と、その産駒のレース
+        min_prize, max_prize = c_prize_money_range[0] * 10**2, c_prize_money_range[1] * 10**2
+        sire_mask = (self._sire_prize >= min_prize) & (self._sire_prize <= max_prize)
+        selected_names = np.zeros(self._name_count + 1, dtype=bool)
+        selected_names[self._sire_name_codes[sire_mask & (self._sire_name_codes >= 0)]] = True
+        race_mask = selected_names[self._race_name_codes]
+
+        if c_dirt_turf != "両方":
+            race_mask &= self._value_mask("芝ダート", [DIRT_TURF_CHOICES[c_dirt_turf]])
+        if c_distance:
+            race_mask &= self._value_mask("距離区分", [d for dist_cat in c_distance for d in DISTANCE_CHOICES.get(dist_cat, [])])
+        if c_condition:
+            race_mask &= self._value_mask("馬場", c_condition)
+        if c_field_cat:
+            race_mask &= self._value_mask("競馬場区分", c_field_cat)
+        return np.flatnonzero(race_mask), np.flatnonzero(sire_mask)
+
+    def filter(self, filter_key: tuple) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        サイドバーの条件で絞り込んだ (df_race, df_sire) を返す
+
+        Args:
+            filter_key: (芝ダート, 距離区分のタプル, 馬場のタプル, 競馬場区分のタプル, 総賞金の範囲(百万円))
+        """
+        with self._cache_lock:
+            positions = self._cache.get(filter_key)
+            if positions is not None:
+                self._cache.move_to_end(filter_key)
+        if positions is None:
+            positions = self._positions(filter_key)
+            with self._cache_lock:
+                self._cache[filter_key] = positions
+                if len(self._cache) > self.max_cached:
+                    self._cache.popitem(last=False)
+        race_positions, sire_positions = positions
+        return self.df_race.iloc[race_positions], self.df_sire.iloc[sire_positions]
+
+
+def rank_group_values(
+    stats: pd.DataFrame,
+    groupby_cols: List[str],
+    data_min: int,
+    top_k: int,
+    page: int = 0,
+    rank_by: str = "出走数",
+    ) -> Tuple[pd.Index | None, int]:
+    """
+    集計済みの成績を groupby_cols の先頭の列の値（騎手など）ごとの合計で順位付けし、page ページ目の top_k 件の値を返す
+
+    勝率で並べる場合、合計の出走数が data_min 未満の値は順位を後ろにする
+
+    Args:
+        stats: race_record_stats / SireCube.stats の結果
+        rank_by: 並び順（RANK_BY_CHOICES のキー）
+    Returns:
+        (順位の順に並べたページの値, ページ数)。値が top_k 件以下の場合は (None, 1)
+    """
+    totals = stats.groupby(groupby_cols[0], observed=True)[RACE_RECORD_COUNT_COLUMNS].sum()
+    if len(totals) <= top_k:
+        return None, 1
+
+    totals = add_race_record_rates(totals)
+    totals["_enough"] = totals["総出走数"] >= data_min
+    order = totals.sort_values(["_enough", RANK_BY_CHOICES[rank_by], "総出走数"], ascending=False, kind="stable").index
+    pages = math.ceil(len(order) / top_k)
+    page = min(max(page, 0), pages - 1)
+    return order[page * top_k:(page + 1) * top_k], pages
+
+
+def rank_record_groups(
+    stats: pd.DataFrame,
+    groupby_cols: List[str],
+    data_min: int,
+    top_k: int,
+    page: int = 0,
+    rank_by: str = "出走数",
+    ) -> Tuple[pd.DataFrame, int]:
+    """
+    rank_group_values で選んだ page ページ目の top_k 件の値の行だけを残す（それ以外の値は「その他」の行にまとめる）
+
+    Returns:
+        (順位の順に並べた成績と「その他」の行, ページ数)。値が top_k 件以下の場合は stats をそのまま返す
+    """
+    selected, pages = rank_group_values(stats, groupby_cols, data_min, top_k, page, rank_by)
+    if selected is None:
+        return stats, pages
+
+    key_col = groupby_cols[0]
+    in_page = stats[key_col].isin(selected)
+    rank = pd.Series(np.arange(len(selected)), index=selected)
+    top = (
+        stats[in_page]
+        .assign(_rank=stats.loc[in_page, key_col].map(rank).astype("int64"))
+        .sort_values("_rank", kind="stable")
+        .drop(columns="_rank")
+        .astype({key_col: object})
+    )
+
+    # ページ以外の値は、残りの切り口ごとに合計して「その他」にする
+    rest = stats[~in_page]
+    if groupby_cols[1:]:
+        others = rest.groupby(groupby_cols[1:], observed=True)[RACE_RECORD_COUNT_COLUMNS].sum().reset_index()
+    else:
+        others = rest[RACE_RECORD_COUNT_COLUMNS].sum().to_frame().T
+    others[key_col] = OTHERS_LABEL
+    others = add_race_record_rates(others)
+    return pd.concat([top, others[top.columns]], ignore_index=True), pages
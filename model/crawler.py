@@ -0,0 +1,361 @@
+import math
+import os
+import re
+from typing import Callable, List
+
+from model.scraping import (
+    get_response, page_title, parse_netkeiba_horse_list_table, crawl_pages, RateLimiter,
+    default_html_cache, default_rate_limiter, latest_race_date, parse_total_count,
+    select_horses_to_refresh,
+)
+from model.utils import (
+    save_jsonl, save_txt, read_jsonl_records, CrawlJournal, compact_sire_to_parquet,
+    find_sire_name, update_manifest,
+)
+
+
+# 進捗の通知先: on_progress(進捗率 0.0~1.0, 状況のテキスト)
+ProgressCallback = Callable[[float, str], None]
+
+
+def _print_progress(fraction: float, text: str) -> None:
+    print(f"[{fraction:6.1%}] {text}")
+
+
+def get_sire_name_from_title(text):
+    m = re.search(r"\[父名\](.+?)\s+所属", text)
+    return m.group(1) if m else None
+
+
+def sire_output_dir(sire_id: str, use_local: bool = False,
+                    s3_bucket: str = "keiba-blood-analyzer-storage", s3_prefix: str = "data") -> str:
+    """種牡馬データの保存先ディレクトリ(data/{sire_id} または s3://bucket/prefix/{sire_id})を返す"""
+    if use_local:
+        return f"data/{sire_id}"
+    return f"s3://{s3_bucket}/{s3_prefix}/{sire_id}"
+
+
+def _sire_list_url(sire_id: str, page: int) -> str:
+    return f'https://db.netkeiba.com/horse/list.html?sire_id={sire_id}&range=all&sort=prize-desc&page={page}'
+
+
+# 産駒リストのページが取得できなかった場合に取り直す回数
+SIRE_PAGE_RETRIES = 2
+
+
+def _fetch_sire_page(sire_id: str, page: int, rate_limiter: RateLimiter, parser: str,
+                     retries: int = SIRE_PAGE_RETRIES, revalidate: bool = False):
+    """
+    産駒リストの1ページを取得する（失敗した場合は retries 回まで取り直し、それでも失敗すればNone）
+
+    Args:
+        revalidate: Trueの場合、キャッシュの有効期限内でも必ずサイトに再検証する
+    """
+    url = _sire_list_url(sire_id, page)
+    if revalidate:
+        default_html_cache.expire(url)
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            # 前回の応答（タイトルのないページなど）がキャッシュされていれば、それを読み直さずにサイトから取り直す
+            default_html_cache.delete(url)
+        soup = get_response(url, rate_limiter=rate_limiter, parser=parser)
+        if soup is not None:
+            return soup
+    return None
+
+
+# 種牡馬の産駒をクローリング
+def scrape_sire_list(
+    sire_id: str,
+    max_pages: int | None = 3,
+    on_progress: ProgressCallback = _print_progress,
+    max_workers: int = 4,
+    rate_limiter: RateLimiter | None = None,
+    parser: str = "bs4",
+    revalidate: bool = False,
+    ):
+    """
+    種牡馬の産駒リストを取得する
+
+    1ページ目の該当件数から総ページ数を求め、2ページ目以降はレートリミッタの範囲で並行して取得する
+    （最終ページより先への無駄なアクセスをしない）。該当件数が読み取れない場合は空のページまで順に取得する
+
+    Args:
+        revalidate: Trueの場合、HTMLキャッシュの有効期限内でも各ページをサイトに再検証する
+            （差分更新で、保存済みの産駒リストとキャッシュの同じ内容を比べないようにする）
+
+    Returns:
+        (産駒リスト, 種牡馬名)。1ページ目が取得できない場合は ([], None)
+
+    Raises:
+        RuntimeError: 2ページ目以降に取り直しても取得できないページがある場合（途中までの産駒リストで上書きしない）
+    """
+    rate_limiter = rate_limiter or default_rate_limiter
+
+    soup = _fetch_sire_page(sire_id, 1, rate_limiter, parser, revalidate=revalidate)
+    if soup is None:
+        on_progress(1.0, "産駒リストの1ページ目が取得できませんでした")
+        return [], None
+
+    title = page_title(soup, parser)
+    sire_horse_name = get_sire_name_from_title(title) if title else None
+    first_rows = parse_netkeiba_horse_list_table(soup, parser=parser)
+    if not first_rows:
+        on_progress(1.0, f"{sire_horse_name} の産駒が見つかりませんでした")
+        return [], sire_horse_name
+
+    total_count = parse_total_count(soup, parser=parser)
+    if total_count is not None:
+        total_pages = math.ceil(total_count / len(first_rows))
+        if max_pages is not None:
+            total_pages = min(total_pages, max_pages)
+        pages = {1: first_rows}
+        on_progress(1 / total_pages, f"{sire_horse_name} のp.1/{total_pages} を取得")
+
+        def _parse(page, soup):
+            return parse_netkeiba_horse_list_table(soup, parser=parser) if soup is not None else None
+
+        targets = [(page, _sire_list_url(sire_id, page)) for page in range(2, total_pages + 1)]
+        if revalidate:
+            for _, url in targets:
+                default_html_cache.expire(url)
+        failed_pages = []
+        for page, rows in crawl_pages(targets, _parse, max_workers=max_workers,
+                                      rate_limiter=rate_limiter, parser=parser):
+            if rows is None:
+                failed_pages.append(page)
+                continue
+            pages[page] = rows
+            on_progress(len(pages) / total_pages, f"{sire_horse_name} のp.{page}/{total_pages} を取得")
+
+        # 取得できなかったページは、キャッシュされた応答を捨てて順に取り直す
+        for page in sorted(failed_pages):
+            default_html_cache.delete(_sire_list_url(sire_id, page))
+            soup = _fetch_sire_page(sire_id, page, rate_limiter, parser)
+            if soup is None:
+                continue
+            pages[page] = parse_netkeiba_horse_list_table(soup, parser=parser)
+            on_progress(len(pages) / total_pages, f"{sire_horse_name} のp.{page}/{total_pages} を取得")
+        _raise_for_missing_pages(sire_horse_name, [page for page in failed_pages if page not in pages], on_progress)
+
+        # ページ順に結合する
+        results = [row for page in sorted(pages) for row in pages[page]]
+    else:
+        # 該当件数が読み取れない場合は、空のページ（＝最終ページの次）まで順に取得する
+        results = list(first_rows)
+        page = 2
+        while max_pages is None or page <= max_pages:
+            on_progress(page / max_pages if max_pages else 0, f"{sire_horse_name} のp.{page} を取得中")
+            soup = _fetch_sire_page(sire_id, page, rate_limiter, parser, revalidate=revalidate)
+            if soup is None:
+                _raise_for_missing_pages(sire_horse_name, [page], on_progress)
+            rows = parse_netkeiba_horse_list_table(soup, parser=parser)
+            if not rows:
+                break
+            results += rows
+            page += 1
+
+    on_progress(1.0, f"取得完了：{title} の産駒{len(results)}馬分")
+    return results, sire_horse_name
+
+
+def _raise_for_missing_pages(sire_horse_name: str | None, missing_pages: List[int], on_progress: ProgressCallback) -> None:
+    if missing_pages:
+        message = f"{sire_horse_name} の産駒リストの p.{', '.join(map(str, missing_pages))} が取得できませんでした"
+        on_progress(1.0, message)
+        raise RuntimeError(message)
+
+
+def scrape_race_data(
+    sire_results: List[dict],
+    output_dir,
+    max_workers: int = 4,
+    rate_limiter: RateLimiter | None = None,
+    parser: str = "bs4",
+    journal: CrawlJournal | None = None,
+    refresh_ids: set | None = None,
+    on_progress: ProgressCallback = _print_progress,
+    ):
+    """
+    産駒ごとのレース戦績を並行して取得し保存する
+
+    Args:
+        sire_results: 産駒リスト(parse_netkeiba_horse_list_tableの結果)
+        output_dir: 保存先ディレクトリ(ローカルまたはs3://bucket/prefix形式)
+        max_workers: 同時に取得するページ数
+        rate_limiter: 全ワーカーで共有するレートリミッタ（省略時はデフォルト設定）
+        parser: HTMLパーサー（"bs4" または高速な "lxml"）
+        journal: 読み込み済みのジャーナル（省略時はoutput_dirから読み込む）
+        refresh_ids: 取得済みでも新しいレースだけを差分取得する産駒のhorse_id
+        on_progress: 進捗の通知先
+
+    Returns:
+        取得・保存に失敗した産駒のhorse_id（ジャーナルに記録しないため、次回の取得で再度取得される）
+    """
+    # 取得済みの産駒はジャーナルから復元する（前回中断していればここでcompactする）
+    if journal is None:
+        journal = CrawlJournal(os.path.join(output_dir, "races"))
+        journal.load()
+    horse_names = journal.horse_names
+    if journal.has_pending():
+        journal.compact()
+
+    refresh_ids = refresh_ids or set()
+
+    # 未取得・差分更新対象の産駒だけを対象にする（horse_idがない・既に読み込み済みの場合はスキップ）
+    targets = []
+    pending_names = {}
+    for sire_data in sire_results:
+        horse_id = sire_data.get("horse_id")
+        if not horse_id or horse_id in pending_names:
+            continue
+        if horse_id in horse_names and horse_id not in refresh_ids:
+            continue
+        pending_names[horse_id] = sire_data.get("horse_name") or horse_id
+        url = f"https://db.netkeiba.com/horse/result/{horse_id}/"
+        if horse_id in refresh_ids:
+            # 更新されたページなのでキャッシュを使わず再検証させる
+            default_html_cache.expire(url)
+        targets.append((horse_id, url))
+
+    def _scrape_and_save(horse_id, soup):
+        if soup is None:
+            return None
+        output_path = os.path.join(output_dir, "races", f"{horse_id}.jsonl")
+        if horse_id in refresh_ids and horse_id in horse_names:
+            # 保存済みの最新レース日より新しい行だけをパースし、先頭に追加する
+            stored = read_jsonl_records(output_path)
+            result = parse_netkeiba_horse_list_table(soup, table_summary_desc='の競走戦績', parser=parser,
+                                                     stop_date=latest_race_date(stored))
+            if result:
+                save_jsonl(result + stored, output_path)
+            return result
+
+        # レース戦績を取得
+        result = parse_netkeiba_horse_list_table(soup, table_summary_desc='の競走戦績', parser=parser)
+        save_jsonl(result, output_path)
+        return result
+
+    done = len(sire_results) - len(targets)
+    failed = []
+    try:
+        for horse_id, result in crawl_pages(targets, _scrape_and_save,
+                                            max_workers=max_workers, rate_limiter=rate_limiter, parser=parser):
+            done += 1
+            if result is None:
+                # 取得・保存に失敗した産駒はジャーナルに記録せず、次回の取得で取り直す
+                failed.append(horse_id)
+                on_progress(done / len(sire_results), f"{pending_names[horse_id]} の raceの取得に失敗しました")
+                continue
+            on_progress(done / len(sire_results), f"{pending_names[horse_id]} の raceを取得完了")
+
+            # 取得完了した1頭分だけをジャーナルに追記
+            journal.append(horse_id, pending_names[horse_id])
+    finally:
+        # 中断された場合も記録済みの分は残し、次回はその続きから再開する
+        journal.flush()
+    journal.compact()
+
+    if failed:
+        on_progress(1.0, f"{len(sire_results) - len(failed)}/{len(sire_results)}馬分の戦績を取得完了"
+                         f"（失敗: {' '.join(failed)}）")
+    else:
+        on_progress(1.0, f"{len(sire_results)}馬分の戦績を取得完了")
+    return failed
+
+
+def _log_failed_horses(failed: List[str], log: Callable[[str], None]) -> None:
+    if failed:
+        log(f"{len(failed)}頭のレース戦績が取得できませんでした（次回の取得で再取得します）: {' '.join(failed)}")
+
+
+def scrape_sire(
+    sire_id: str,
+    output_dir: str,
+    max_pages: int | None = 3,
+    incremental: bool = False,
+    max_workers: int = 4,
+    rate_limiter: RateLimiter | None = None,
+    parser: str = "bs4",
+    on_sire_progress: ProgressCallback = _print_progress,
+    on_race_progress: ProgressCallback = _print_progress,
+    log: Callable[[str], None] = print,
+    ) -> bool:
+    """
+    種牡馬1頭分の産駒リストと産駒ごとのレース戦績を取得し、output_dir に保存する
+
+    Args:
+        sire_id: 種牡馬ID
+        output_dir: 保存先ディレクトリ(ローカルまたはs3://bucket/prefix形式)
+        max_pages: 産駒リストの最大ページ数
+        incremental: Trueの場合、取得済みの産駒も産駒リストの賞金・出走の列が変わっていれば
+            新しいレースだけを差分取得する
+        on_sire_progress: 産駒リスト取得の進捗の通知先
+        on_race_progress: レース戦績取得の進捗の通知先
+        log: メッセージの出力先
+
+    Returns:
+        産駒データを保存できた場合はTrue
+    """
+    race_kwargs = dict(max_workers=max_workers, rate_limiter=rate_limiter, parser=parser,
+                       on_progress=on_race_progress)
+    sire_file = os.path.join(output_dir, f"{sire_id}.jsonl")
+
+    # 前回のレース取得が中断されていた場合は、産駒リストを取り直さずに保存済みのものから再開する
+    journal = CrawlJournal(os.path.join(output_dir, "races"))
+    journal.load()
+    if journal.has_pending():
+        sire_results = read_jsonl_records(sire_file)
+        if sire_results:
+            log(f"前回中断した取得を再開します（取得済み{len(journal.horse_names)}頭）")
+            failed = scrape_race_data(sire_results, output_dir, journal=journal, **race_kwargs)
+            _log_failed_horses(failed, log)
+            compact_sire(sire_id, output_dir, log=log)
+            return True
+
+    # 差分更新の場合は、上書きする前に前回の産駒リストを読み込んでおく
+    previous_sire_results = read_jsonl_records(sire_file) if incremental else []
+
+    # （１）種牡馬の産駒のリストをスクレイピング
+    sire_results, sire_horse_name = scrape_sire_list(
+        sire_id, max_pages=max_pages, on_progress=on_sire_progress,
+        max_workers=max_workers, rate_limiter=rate_limiter, parser=parser,
+        # 差分更新では、キャッシュではなくサイトの最新の産駒リストと比べる
+        revalidate=incremental,
+    )
+    if sire_results == []:
+        return False
+    # タイトルから種牡馬名が読み取れない場合はsire_idで代用する
+    sire_horse_name = sire_horse_name or sire_id
+
+    name_file = os.path.join(output_dir, f"{sire_horse_name}.txt")
+    save_txt(sire_horse_name, name_file)
+    save_jsonl(sire_results, sire_file)
+
+    # （２）産駒ごとにレース結果を取得
+    refresh_ids = select_horses_to_refresh(previous_sire_results, sire_results)
+    if incremental:
+        log(f"差分更新の対象: {len(refresh_ids)}頭")
+    failed = scrape_race_data(sire_results, output_dir, journal=journal, refresh_ids=refresh_ids, **race_kwargs)
+    _log_failed_horses(failed, log)
+    compact_sire(sire_id, output_dir, sire_horse_name=sire_horse_name, log=log)
+    return True
+
+
+def compact_sire(sire_id: str, output_dir: str, sire_horse_name: str | None = None,
+                 log: Callable[[str], None] = print) -> None:
+    """
+    保存済みのJSONLを読み込み用のParquetにまとめ（取得のたびに作り直して最新の状態に保つ）、
+    種牡馬カタログのマニフェストを更新する
+    """
+    log("読み込み用のParquetを作成中")
+    summary = compact_sire_to_parquet(output_dir, sire_id)
+
+    # マニフェストは種牡馬ディレクトリの1つ上（data/ または s3://bucket/data）に置く
+    data_root = output_dir.rstrip('/').rsplit('/', 1)[0]
+    sire_horse_name = sire_horse_name or find_sire_name(output_dir) or sire_id
+    update_manifest(data_root, sire_id, {
+        "name": sire_horse_name,
+        "horse_count": summary["horse_count"],
+        "race_count": summary["race_count"],
+    })
@@ -1,13 +1,20 @@
 from bs4 import BeautifulSoup
 import requests
+import requests.adapters
 
+import hashlib
 import json
+import os
 import re
+from functools import lru_cache
 from urllib.parse import urljoin
 from urllib.parse import urlparse, parse_qs
 
 import time
-from typing import List
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
 import pandas as pd
 
 
@@ -25,22 +32,268 @@ def extract_sire_id(url: str) -> str | None:
     return None
 
 
-def get_response(url: str):
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッタ(スレッドセーフ)
+
+    Args:
+        rate: 1秒あたりに補充されるトークン数(=平均リクエスト数/秒)
+        capacity: バケットに溜められる最大トークン数(=許容するバースト数)
+    """
+
+    def __init__(self, rate: float = 1.0, capacity: float = 2.0):
+        if rate <= 0:
+            raise ValueError("rateは正の値を指定してください")
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンを1つ取得する。足りない場合は補充されるまで待機する"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# 1ホストあたりのデフォルトのリクエスト数/秒と最大バースト数
+# 以前の逐次取得の待ち時間（1頭あたり2〜3秒・産駒リスト1ページあたり2秒）と同じ程度に抑え、
+# 並行取得では待ち時間の重なりだけで速くする（これより速くする場合は呼び出し側で指定する）
+DEFAULT_RATE = 0.35
+DEFAULT_BURST = 1.0
+
+
+class RateLimiter:
+    """
+    ホストごとにトークンバケットを持つレートリミッタ
+    全ワーカーで1つのインスタンスを共有し、アクセス間隔（マナー）を守る
+
+    Args:
+        rate: ホストごとの平均リクエスト数/秒（デフォルトは以前の待ち時間（1頭あたり2〜3秒）と同じ程度）
+        capacity: ホストごとの最大バースト数
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: float = DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url: str) -> None:
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.capacity)
+        bucket.acquire()
+
+
+# プロセス内で共有するデフォルトのレートリミッタ
+default_rate_limiter = RateLimiter()
+
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_maxsize: int = 16) -> requests.Session:
+    """
+    プロセス内で共有するrequests.Sessionを返す
+    コネクションを使い回すことで、ページごとのTCP/TLSハンドシェイクを省く
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({'User-Agent': USER_AGENT})
+            _session = session
+    return _session
+
+
+class HtmlCache:
+    """
+    取得したHTMLをURLのハッシュをキーにローカルへ保存するキャッシュ
+
+    - ttl秒以内のページはネットワークにアクセスせずディスクから返す
+    - ttlを過ぎたページは ETag / Last-Modified で再検証し、304ならディスクの内容を使う
+    - 合計サイズが max_bytes を超えたら、最後に参照された時刻が古い順に削除する
+
+    Args:
+        cache_dir: キャッシュの保存先ディレクトリ
+        ttl: 再検証なしで使う有効期限(秒)
+        max_bytes: キャッシュの最大合計サイズ(バイト)
+    """
+
+    def __init__(self, cache_dir: str = "cache/html", ttl: float = 24 * 3600,
+                 max_bytes: int = 1024 ** 3, evict_interval: int = 100):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def _paths(self, url: str) -> Tuple[Path, Path]:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = self.cache_dir / digest[:2] / digest
+        return base.with_suffix(".html"), base.with_suffix(".json")
+
+    def get(self, url: str) -> Tuple[bytes | None, dict | None]:
+        """キャッシュ済みの (HTMLのバイト列, メタ情報) を返す。なければ (None, None)"""
+        html_path, meta_path = self._paths(url)
+        try:
+            content = html_path.read_bytes()
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None, None
+        # LRU判定用に最終参照時刻を更新
+        os.utime(html_path)
+        return content, meta
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time.time() - meta.get("fetched_at", 0) < self.ttl
+
+    def put(self, url: str, content: bytes, etag: str | None = None, last_modified: str | None = None) -> None:
+        html_path, meta_path = self._paths(url)
+        html_path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}
+        # 書き込み途中のファイルを読まないよう、一時ファイル経由で置き換える
+        tmp_path = html_path.with_suffix(f".tmp{threading.get_ident()}")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, html_path)
+        meta_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+        with self._lock:
+            self._puts += 1
+            should_evict = self._puts % self.evict_interval == 0
+        if should_evict:
+            self.evict()
+
+    def touch(self, url: str, fetched_at: float | None = None) -> None:
+        """再検証で変更がなかった(304)ページの取得時刻を更新する"""
+        _, meta_path = self._paths(url)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        meta["fetched_at"] = time.time() if fetched_at is None else fetched_at
+        meta_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+    def expire(self, url: str) -> None:
+        """ページが更新されたと分かっている場合に、次回の取得で必ず再検証させる"""
+        self.touch(url, fetched_at=0)
+
+    def delete(self, url: str) -> None:
+        """キャッシュしたページを削除する（内容が壊れていた場合に、次回の取得で取り直させる）"""
+        for path in self._paths(url):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> None:
+        """合計サイズが max_bytes 以下になるまで、参照が古いものから削除する"""
+        entries = []
+        total = 0
+        for html_path in self.cache_dir.glob("*/*.html"):
+            try:
+                stat = html_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, html_path))
+            total += stat.st_size
+
+        for _, size, html_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (html_path, html_path.with_suffix(".json")):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+
+# プロセス内で共有するデフォルトのHTMLキャッシュ
+default_html_cache = HtmlCache()
+
+
+def fetch_html(
+    url: str,
+    rate_limiter: RateLimiter | None = None,
+    cache: HtmlCache | None = default_html_cache,
+    ) -> bytes | None:
+    """
+    URLのHTMLをバイト列で取得する（キャッシュ・共有セッション対応）
+    ネットワークにアクセスする場合のみ rate_limiter のトークンを消費する
+
+    Args:
+        url: 取得するURL
+        rate_limiter: 共有するレートリミッタ（Noneの場合は制限しない）
+        cache: HTMLキャッシュ（Noneの場合は使用しない）
+    """
+    content, meta = cache.get(url) if cache is not None else (None, None)
+    if content is not None and cache.is_fresh(meta):
+        return content
+
+    headers = {}
+    if meta:
+        # 条件付きリクエストで変更の有無だけを確認する
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    if rate_limiter is not None:
+        rate_limiter.acquire(url)
+    response = get_session().get(url, headers=headers, timeout=30)
+    if response.status_code == 304 and content is not None:
+        cache.touch(url)
+        return content
+    response.raise_for_status()  # HTTPエラーがあれば例外を発生させる
+
+    if cache is not None:
+        cache.put(url, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return response.content
+
+
+def get_response(
+    url: str,
+    rate_limiter: RateLimiter | None = None,
+    cache: HtmlCache | None = default_html_cache,
+    parser: str = "bs4",
+    ):
+  """
+  URLのHTMLを取得してパースする
+
+  Args:
+      parser: "bs4"(BeautifulSoup/html.parser) または "lxml"(lxml.htmlのドキュメントを返す)
+  """
   try:
-      # User-Agentヘッダーを追加して、ブラウザからのアクセスを模倣
-      headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-      response = requests.get(url, headers=headers)
-      response.raise_for_status()  # HTTPエラーがあれば例外を発生させる
+      content = fetch_html(url, rate_limiter=rate_limiter, cache=cache)
 
-      # EUC-JPでデコードしてからBeautifulSoupに渡す
-      html_content = response.content.decode('euc-jp', 'ignore')
+      # EUC-JPでデコードしてからパーサーに渡す
+      html_content = content.decode('euc-jp', 'ignore')
 
-      # BeautifulSoupでHTMLをパース
-      soup = BeautifulSoup(html_content, 'html.parser')
+      soup = parse_html(html_content, parser=parser)
+      title = page_title(soup, parser)
 
       print("--- 取得したHTMLのタイトル ---")
-      if soup.title:
-          print(soup.title.string)
+      if title is not None:
+          print(title)
           return soup
       else:
           print("タイトルが見つかりませんでした。")
@@ -52,6 +305,63 @@ def get_response(url: str):
   return None
 
 
+def crawl_pages(
+    targets: Iterable[Tuple[Any, str]],
+    handler: Callable[[Any, Any], Any],
+    max_workers: int = 4,
+    rate_limiter: RateLimiter | None = None,
+    parser: str = "bs4",
+    ) -> Iterator[Tuple[Any, Any]]:
+    """
+    複数のページを並行して取得し、完了した順に (key, handlerの戻り値) を返すジェネレータ
+    リクエストは rate_limiter で全ワーカー共通の上限に抑えられる
+
+    Args:
+        targets: (key, url) のリスト
+        handler: handler(key, soup) の形で呼ばれる処理（パース・保存など）
+            取得に失敗した場合 soup は None になる
+        max_workers: 同時に処理するリクエスト数
+        rate_limiter: 共有するレートリミッタ（省略時はdefault_rate_limiter）
+        parser: get_response に渡すパーサー（"bs4" または "lxml"）
+    """
+    rate_limiter = rate_limiter or default_rate_limiter
+
+    def _task(key, url):
+        soup = get_response(url, rate_limiter=rate_limiter, parser=parser)
+        try:
+            return handler(key, soup)
+        except Exception as e:
+            print(f"{url} の処理中にエラーが発生しました: {e}")
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(_task, key, url): key for key, url in targets}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # 途中で中断された場合は未着手のリクエストを破棄する
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_html(html_content: str, parser: str = "bs4"):
+    """HTML文字列を指定したパーサーでパースする（"bs4" または "lxml"）"""
+    if parser == "lxml":
+        import lxml.html
+        return lxml.html.document_fromstring(html_content)
+    if parser == "bs4":
+        return BeautifulSoup(html_content, 'html.parser')
+    raise ValueError(f"未対応のparserです: {parser}")
+
+
+def page_title(soup, parser: str = "bs4") -> str | None:
+    """get_response の結果からページのタイトルを返す（ない場合はNone）"""
+    if parser == "lxml":
+        title = soup.find(".//title")
+        return title.text_content() if title is not None else None
+    return soup.title.string if soup.title else None
+
+
 def _clean_text(s: str) -> str:
     if s is None:
         return ""
@@ -71,13 +381,136 @@ def _a_tags_info(td, base_url: str):
         )
     return items
 
+def parse_total_count(soup, parser: str = "bs4") -> int | None:
+    """
+    産駒リスト(検索結果)ページから該当件数を取り出す
+    例: "1,234件中1～20件目" → 1234。見つからない場合は None
+    """
+    text = soup.text_content() if parser == "lxml" else soup.get_text(" ")
+    m = re.search(r"([\d,]+)\s*件中", text) or re.search(r"該当件数[^\d]*([\d,]+)\s*件", text)
+    return int(m.group(1).replace(",", "")) if m else None
+
+
+def race_date(row: dict) -> str | None:
+    """競走戦績の行から日付("YYYY/MM/DD")を取り出す"""
+    date = row.get("_raw", {}).get("日付", {}).get("text")
+    return date or None
+
+
+def latest_race_date(rows: List[dict]) -> str | None:
+    """保存済みの競走戦績のうち最も新しいレースの日付を返す"""
+    dates = [d for d in map(race_date, rows) if d]
+    return max(dates) if dates else None
+
+
+def _reached_stop_date(row: dict, stop_date: str) -> bool:
+    date = race_date(row)
+    # "YYYY/MM/DD" 形式なので文字列のまま大小比較できる
+    return date is not None and date <= stop_date
+
+
+# 再取得の要否を判定する産駒リストの列（賞金・出走に関する列）
+_REFRESH_COLUMN_PATTERN = re.compile(r"賞金|出走|前走")
+
+
+def _refresh_signature(row: dict) -> tuple:
+    texts = {}
+    for key, value in row.get("_raw", {}).items():
+        key = key.replace(' ↑ ↓', '').replace(' ', '').strip()
+        texts[key] = value.get("text", "") if isinstance(value, dict) else ""
+    signature = tuple(sorted((k, v) for k, v in texts.items() if _REFRESH_COLUMN_PATTERN.search(k)))
+    # 該当する列がない場合は行全体で比較する
+    return signature or tuple(sorted(texts.items()))
+
+
+def select_horses_to_refresh(previous_results: List[dict], current_results: List[dict]) -> set:
+    """
+    前回と今回の産駒リストを比較し、賞金・出走の列が変わった（＝新しいレースに出走した）産駒のhorse_idを返す
+    前回のリストにない産駒は対象外（未取得の産駒として通常どおり全件取得される）
+    """
+    previous = {row.get("horse_id"): _refresh_signature(row) for row in previous_results if row.get("horse_id")}
+    return {
+        row["horse_id"]
+        for row in current_results
+        if row.get("horse_id") in previous and previous[row["horse_id"]] != _refresh_signature(row)
+    }
+
+
+# URLの結合結果を使い回す（同じ相対パスのリンクが大量に出現するため）
+_cached_urljoin = lru_cache(maxsize=8192)(urljoin)
+
+# BeautifulSoupのget_textと同様に、script/style内の文字列は除外する
+_LXML_TEXT_XPATH = ".//text()[not(parent::script) and not(parent::style)]"
+
+
+def _lxml_text(el) -> str:
+    """lxmlの要素から get_text(" ", strip=True) 相当のテキストを取り出す"""
+    return _clean_text(" ".join(t.strip() for t in el.xpath(_LXML_TEXT_XPATH) if t.strip()))
+
+
+def _parse_netkeiba_horse_list_table_lxml(doc, base_url: str, table_summary_desc: str, stop_date: str | None = None):
+    """parse_netkeiba_horse_list_tableのlxml版。ヘッダ・horse_id・テキスト・リンクを1回の走査で取り出す"""
+    pattern = re.compile(table_summary_desc)
+    table = next((t for t in doc.iter("table") if pattern.search(t.get("summary") or "")), None)
+    if table is None:
+        print("対象テーブルが見つかりません（セレクタ/summaryを見直してください）")
+        return []
+
+    trs = list(table.iter("tr"))
+    if not trs:
+        return []
+    headers = [_lxml_text(th) for th in trs[0].iter("th")]
+
+    results = []
+    for tr in trs[1:]:
+        row = {"_raw": {}, "horse_id": None}
+        tds = []
+        for el in tr.iter("td", "input"):
+            if el.tag == "td":
+                tds.append(el)
+            elif (row["horse_id"] is None and el.get("type") == "checkbox"
+                  and (el.get("name") or "").startswith("i-horse_") and el.get("value")):
+                row["horse_id"] = el.get("value")
+        if not tds:
+            continue
+
+        for i, td in enumerate(tds):
+            key = headers[i] if i < len(headers) else f"col_{i}"
+            links = []
+            for a in td.iter("a"):
+                href = a.get("href")
+                if href is None:
+                    continue
+                links.append(
+                    {
+                        "text": _lxml_text(a),
+                        "href": _cached_urljoin(base_url, href),
+                        "title": a.get("title") or None,
+                    }
+                )
+            row["_raw"][key] = {"text": _lxml_text(td), "links": links}
+
+        if stop_date is not None and _reached_stop_date(row, stop_date):
+            break
+
+        row["horse_name"] = row["_raw"].get("馬名 ↑ ↓", {}).get("text", "")
+        results.append(row)
+    return results
+
+
 # 馬のテーブルのHTMLをそのままパースしJSONLで返す
 def parse_netkeiba_horse_list_table(
     soup, base_url:
     str = "https://db.netkeiba.com/",
-    table_summary_desc = "競走馬検索結果"
+    table_summary_desc = "競走馬検索結果",
+    parser: str = "bs4",
+    stop_date: str | None = None,
     ):
   '''
+  parser="lxml" の場合、soupには get_response(..., parser="lxml") の戻り値を渡す
+  stop_date ("YYYY/MM/DD") を指定すると、日付がそれ以前の行に達した時点でパースを打ち切る
+  （競走戦績は新しい順に並んでいるため、保存済みの最新レース日を渡せば差分だけが返る）
+
   [
     {
       _raw: {
@@ -96,6 +529,9 @@ def parse_netkeiba_horse_list_table(
     }
   ]
   '''
+  if parser == "lxml":
+    return _parse_netkeiba_horse_list_table_lxml(soup, base_url, table_summary_desc, stop_date)
+
   table = soup.find("table", summary=re.compile(table_summary_desc))
   if table is None:
         print("対象テーブルが見つかりません（セレクタ/summaryを見直してください）")
@@ -133,6 +569,9 @@ def parse_netkeiba_horse_list_table(
                 "links": _a_tags_info(td, base_url),
             }
 
+        if stop_date is not None and _reached_stop_date(row, stop_date):
+            break
+
         row["horse_name"] = row["_raw"].get("馬名 ↑ ↓", {}).get("text", "")
 
         results.append(row)
@@ -0,0 +1,323 @@
+"""
+全種牡馬のクリーニング済みデータをまとめて持つローカルの分析用データベース(DuckDB)
+
+    python -m model.store                      # S3の data/ 以下の全種牡馬を取り込む
+    python -m model.store --data-root data     # ローカルの data/ から取り込む
+
+種牡馬ごとに DataFrame を読み込まなくても、種牡馬をまたいだ集計（「小倉の芝1200で勝率が高い種牡馬は？」など）を
+SQL 1回で行えるようにする。テーブルは以下の3つ
+- sires : 種牡馬（sire_id, 種牡馬名, 産駒数, レース数, 取り込んだデータのversion）
+- horses: 産駒（産駒リストの列 + sire_id）
+- races : レース戦績（clean_race_df 後の列 + sire_id, 日付をDATEにした race_date）
+"""
+import argparse
+from typing import Any, Callable, Dict, Iterable, List
+
+import pandas as pd
+
+from model.utils import (
+    RACE_RECORD_COUNT_COLUMNS, add_race_record_rates, build_horse_dict, build_horse_dict_from_manifest,
+    load_manifest, read_horse_raw_data,
+)
+
+DEFAULT_DB_PATH = "cache/keiba.duckdb"
+
+# 取り込む列と型（種牡馬によって列の有無が違うため、固定のスキーマにそろえる）
+HORSE_COLUMNS = {
+    "sire_id": "VARCHAR",
+    "horse_id": "VARCHAR",
+    "馬名": "VARCHAR",
+    "性": "VARCHAR",
+    "生年": "INTEGER",
+    "厩舎": "VARCHAR",
+    "父": "VARCHAR",
+    "母": "VARCHAR",
+    "母父": "VARCHAR",
+    "馬主": "VARCHAR",
+    "生産者": "VARCHAR",
+    "総賞金(万円)": "DOUBLE",
+}
+
+RACE_COLUMNS = {
+    "sire_id": "VARCHAR",
+    "horse_id": "VARCHAR",
+    "馬名": "VARCHAR",
+    "日付": "VARCHAR",
+    "race_date": "DATE",
+    "開催": "VARCHAR",
+    "天気": "VARCHAR",
+    "R": "DOUBLE",
+    "レース名": "VARCHAR",
+    "頭数": "DOUBLE",
+    "枠番": "DOUBLE",
+    "馬番": "DOUBLE",
+    "オッズ": "DOUBLE",
+    "人気": "DOUBLE",
+    "着順": "DOUBLE",
+    "騎手": "VARCHAR",
+    "斤量": "DOUBLE",
+    "距離": "VARCHAR",
+    "馬場": "VARCHAR",
+    "タイム": "VARCHAR",
+    "着差": "DOUBLE",
+    "通過": "VARCHAR",
+    "ペース": "VARCHAR",
+    "上り": "DOUBLE",
+    "馬体重": "VARCHAR",
+    "賞金": "VARCHAR",
+    "芝ダート": "VARCHAR",
+    "距離_m": "DOUBLE",
+    "距離区分": "VARCHAR",
+    "クラス": "VARCHAR",
+    "競馬場": "VARCHAR",
+    "競馬場区分": "VARCHAR",
+    "カーブ": "VARCHAR",
+    "月": "DOUBLE",
+    "季節": "VARCHAR",
+    "1着": "BOOLEAN",
+    "2着": "BOOLEAN",
+    "3着": "BOOLEAN",
+    "掲示板": "BOOLEAN",
+}
+
+# 絞り込み・集計でよく使う列のインデックス
+RACE_INDEXES = {
+    "races_sire_idx": "sire_id",
+    "races_horse_idx": "horse_id",
+    "races_track_idx": "競馬場",
+    "races_distance_idx": "距離区分",
+    "races_date_idx": "race_date",
+}
+
+
+def _quote(name: str) -> str:
+    """列名をSQLの識別子としてクォートする（日本語・記号を含むため）"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(db_path: str = DEFAULT_DB_PATH, read_only: bool = False):
+    """
+    データベースに接続し、テーブルとインデックスがなければ作成する
+
+    Args:
+        db_path: DuckDBのファイルパス（":memory:" でメモリ上に作成）
+        read_only: 読み込み専用で開く（Streamlitなど複数のプロセスから参照する場合）
+    """
+    import duckdb
+    from pathlib import Path
+
+    if db_path != ":memory:":
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect(db_path, read_only=read_only)
+    if read_only:
+        return con
+
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS sires (
+            sire_id VARCHAR PRIMARY KEY,
+            name VARCHAR,
+            horse_count INTEGER,
+            race_count INTEGER,
+            version VARCHAR,
+            ingested_at TIMESTAMP
+        )
+    """)
+    for table, columns in (("horses", HORSE_COLUMNS), ("races", RACE_COLUMNS)):
+        ddl = ", ".join(f"{_quote(col)} {dtype}" for col, dtype in columns.items())
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({ddl})")
+    con.execute("CREATE INDEX IF NOT EXISTS horses_sire_idx ON horses (sire_id)")
+    for index_name, col in RACE_INDEXES.items():
+        con.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON races ({_quote(col)})")
+    return con
+
+
+def _conform(df: pd.DataFrame, columns: Dict[str, str]) -> pd.DataFrame:
+    """DataFrameの列をテーブルの列にそろえる（ない列はNULL、余分な列は落とす）"""
+    return df.reindex(columns=list(columns))
+
+
+def ingest_sire(con, sire_id: str, sire_name: str, df_sire: pd.DataFrame, df_race: pd.DataFrame,
+                version: str | None = None) -> None:
+    """
+    クリーニング済みの種牡馬1頭分のデータを取り込む（取り込み済みの場合は置き換える）
+
+    Args:
+        con: connect の戻り値
+        df_sire: clean_sire_horse_df 後の産駒リスト
+        df_race: clean_race_df 後のレースデータ
+        version: 取り込んだデータのversion（マニフェストの更新日時）。次回の取り込みで変更の有無の判定に使う
+    """
+    df_sire = df_sire.assign(sire_id=sire_id)
+    df_race = df_race.assign(
+        sire_id=sire_id,
+        race_date=pd.to_datetime(df_race["日付"], format="%Y/%m/%d", errors="coerce") if "日付" in df_race else pd.NaT,
+    )
+    horses = _conform(df_sire, HORSE_COLUMNS)
+    races = _conform(df_race, RACE_COLUMNS)
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute("DELETE FROM horses WHERE sire_id = ?", [sire_id])
+        con.execute("DELETE FROM races WHERE sire_id = ?", [sire_id])
+        con.register("horses_df", horses)
+        con.register("races_df", races)
+        for table, columns in (("horses", HORSE_COLUMNS), ("races", RACE_COLUMNS)):
+            select = ", ".join(f"CAST({_quote(col)} AS {dtype})" for col, dtype in columns.items())
+            con.execute(f"INSERT INTO {table} SELECT {select} FROM {table}_df")
+        con.execute(
+            "INSERT OR REPLACE INTO sires VALUES (?, ?, ?, ?, ?, now())",
+            [sire_id, sire_name, len(horses), len(races), version],
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.unregister("horses_df")
+        con.unregister("races_df")
+
+
+def ingest(
+    data_root: str = "s3://keiba-blood-analyzer-storage/data",
+    db_path: str = DEFAULT_DB_PATH,
+    sire_ids: Iterable[str] | None = None,
+    force: bool = False,
+    log: Callable[[str], None] = print,
+    ) -> int:
+    """
+    data_root 以下の全種牡馬（または sire_ids で指定した種牡馬）を読み込み、クリーニングしてデータベースに取り込む
+
+    マニフェストの更新日時が前回の取り込みから変わっていない種牡馬はスキップする（force=Trueで全て取り込み直す）
+
+    Returns:
+        取り込んだ種牡馬の数
+    """
+    manifest = load_manifest(data_root)
+    if manifest["sires"]:
+        sire_horse_dict = build_horse_dict_from_manifest(manifest, data_root)
+    elif data_root.startswith("s3://"):
+        bucket, _, prefix = data_root.replace("s3://", "").partition("/")
+        sire_horse_dict = build_horse_dict(bucket=bucket, prefix=prefix)
+    else:
+        sire_horse_dict = build_horse_dict(data_root, use_s3=False)
+
+    wanted = set(sire_ids) if sire_ids else None
+    con = connect(db_path)
+    try:
+        ingested_versions = dict(con.execute("SELECT sire_id, version FROM sires").fetchall())
+        count = 0
+        for sire_name, entry in sire_horse_dict.items():
+            sire_id = entry["horse_id"]
+            if wanted is not None and sire_id not in wanted:
+                continue
+            version = entry.get("version")
+            if not force and version is not None and ingested_versions.get(sire_id) == version:
+                log(f"{sire_name}: 変更なし（スキップ）")
+                continue
+            df_sire, df_race = read_horse_raw_data(sire_name, sire_horse_dict)
+            ingest_sire(con, sire_id, sire_name, df_sire, df_race, version=version)
+            log(f"{sire_name}: 産駒{len(df_sire)}頭・{len(df_race)}レースを取り込みました")
+            count += 1
+        con.execute("CHECKPOINT")
+    finally:
+        con.close()
+    return count
+
+
+# race_record_stats の絞り込み条件（アプリのサイドバーの条件に対応する）
+def _where_clause(filters: Dict[str, Any]) -> tuple[List[str], List[Any]]:
+    conditions, params = [], []
+    for col, value in filters.items():
+        if value is None or (isinstance(value, (list, tuple, set)) and not value):
+            continue
+        if col == "総賞金(万円)":
+            # 産駒の総賞金の範囲 (min, max)
+            conditions.append(
+                "EXISTS (SELECT 1 FROM horses h WHERE h.sire_id = r.sire_id AND h.馬名 = r.馬名 "
+                "AND h.\"総賞金(万円)\" BETWEEN ? AND ?)"
+            )
+            params.extend(value)
+        elif isinstance(value, (list, tuple, set)):
+            conditions.append(f"r.{_quote(col)} IN ({', '.join('?' for _ in value)})")
+            params.extend(value)
+        else:
+            conditions.append(f"r.{_quote(col)} = ?")
+            params.append(value)
+    return conditions, params
+
+
+def race_record_stats(
+    con,
+    groupby_cols: List[str],
+    filters: Dict[str, Any] | None = None,
+    data_min: int = 1,
+    ) -> pd.DataFrame:
+    """
+    条件ごとの成績を集計する（model.utils.race_record_stats と同じ列・同じ値を返す）
+
+    groupby_cols に "sire_id" や "種牡馬" を含めると種牡馬をまたいで集計できる
+
+        # 小倉の芝1200で勝率が高い種牡馬
+        race_record_stats(con, ["種牡馬"], {"競馬場": "小倉", "芝ダート": "芝", "距離_m": 1200}, data_min=30)
+            .sort_values("勝率", ascending=False)
+
+    Args:
+        con: connect の戻り値
+        groupby_cols: 集計する列（races の列または "種牡馬"）
+        filters: {列名: 値 または 値のリスト}。"総賞金(万円)" には産駒の総賞金の範囲 (min, max) を指定する
+        data_min: 総出走数がこれ未満の条件は除く
+
+    Returns:
+        groupby_cols + RACE_RECORD_COUNT_COLUMNS + 勝率・連帯率・複勝率・掲示板率 の列のDataFrame（条件の昇順）
+    """
+    group_exprs = ["s.name" if col == "種牡馬" else f"r.{_quote(col)}" for col in groupby_cols]
+    select_groups = ", ".join(f"{expr} AS {_quote(col)}" for expr, col in zip(group_exprs, groupby_cols))
+
+    conditions, params = _where_clause(filters or {})
+    # pandasのgroupbyと同様に、芝ダート・集計する列が欠損している行は除く
+    conditions += ["r.芝ダート IS NOT NULL"] + [f"{expr} IS NOT NULL" for expr in group_exprs]
+
+    sql = f"""
+        SELECT
+            {select_groups},
+            COUNT(r.着順) AS 総出走数,
+            CAST(SUM(CASE WHEN r.着順 = 1 THEN 1 ELSE 0 END) AS BIGINT) AS 勝利数,
+            CAST(SUM(CASE WHEN r.着順 <= 2 THEN 1 ELSE 0 END) AS BIGINT) AS 連帯数,
+            CAST(SUM(CASE WHEN r.着順 <= 3 THEN 1 ELSE 0 END) AS BIGINT) AS 複勝数,
+            CAST(SUM(CASE WHEN r.着順 <= 5 THEN 1 ELSE 0 END) AS BIGINT) AS 掲示板内数,
+            CAST(SUM(CASE WHEN r.着順 = 2 THEN 1 ELSE 0 END) AS BIGINT) AS 二着数,
+            CAST(SUM(CASE WHEN r.着順 = 3 THEN 1 ELSE 0 END) AS BIGINT) AS 三着数,
+            CAST(SUM(CASE WHEN r.着順 BETWEEN 4 AND 5 THEN 1 ELSE 0 END) AS BIGINT) AS 掲示板数
+        FROM races r
+        JOIN sires s ON s.sire_id = r.sire_id
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {', '.join(group_exprs)}
+        HAVING COUNT(r.着順) >= ?
+        ORDER BY {', '.join(group_exprs)}
+    """
+    stats = con.execute(sql, params + [data_min]).df()
+    stats[RACE_RECORD_COUNT_COLUMNS] = stats[RACE_RECORD_COUNT_COLUMNS].astype("int64")
+    return add_race_record_rates(stats)
+
+
+def query(con, sql: str, params: List[Any] | None = None) -> pd.DataFrame:
+    """任意のSQLを実行してDataFrameで返す（テーブルは sires / horses / races）"""
+    return con.execute(sql, params or []).df()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("sire_ids", nargs="*", help="取り込む種牡馬のsire_id（省略時は全種牡馬）")
+    ap.add_argument("--data-root", default="s3://keiba-blood-analyzer-storage/data",
+                    help="種牡馬データのルートディレクトリ（data または s3://bucket/data）")
+    ap.add_argument("--db", default=DEFAULT_DB_PATH, help="DuckDBのファイルパス")
+    ap.add_argument("--force", action="store_true", help="変更がない種牡馬も取り込み直す")
+    args = ap.parse_args(argv)
+
+    count = ingest(args.data_root, db_path=args.db, sire_ids=args.sire_ids, force=args.force)
+    print(f"完了: {count}頭の種牡馬を取り込みました")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
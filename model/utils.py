@@ -1,18 +1,51 @@
 import json
 import os
+import re
 import glob
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Iterator
+import numpy as np
 import pandas as pd
-import boto3
+import hashlib
 import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-s3 = boto3.client('s3',region_name='ap-northeast-1')
+# JSONのデコード（orjsonがインストールされていれば、bytesのまま高速にデコードする）
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-bucket_name = 'keiba-blood-analyzer-storage'  # バケット名を設定してください
-key = 'data/field_info.json'  # S3のオブジェクトキーを設定してください
+# S3から並行して読み込む際の最大同時接続数（クライアントのコネクションプールもこの大きさにする）
+S3_MAX_POOL_CONNECTIONS = 32
 
-def save_txt(content: str, filepath: str, s3=s3) -> None:
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    プロセスで共有するboto3のS3クライアントを返す（初回呼び出し時に作成する）
+
+    import時にはboto3の読み込みも認証情報も不要にするため、実際にS3を使うまで作らない
+    各関数の引数 s3 を省略した（None の）場合はこのクライアントを使う
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                from botocore.config import Config
+                _s3_client = boto3.client('s3', region_name='ap-northeast-1',
+                                          config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    return _s3_client
+
+
+def save_txt(content: str, filepath: str, s3=None) -> None:
     """
     テキストファイルを保存する関数(S3対応)
     
@@ -27,7 +60,7 @@ def save_txt(content: str, filepath: str, s3=s3) -> None:
         key = path_parts[1] if len(path_parts) > 1 else ''
         
         # S3にアップロード
-        s3.put_object(
+        (s3 or get_s3_client()).put_object(
             Bucket=bucket,
             Key=key,
             Body=content.encode('utf-8')
@@ -39,7 +72,7 @@ def save_txt(content: str, filepath: str, s3=s3) -> None:
             f.write(content)
 
 
-def save_jsonl(data: List[Dict[str, Any]], filepath: str, s3=s3) -> None:
+def save_jsonl(data: List[Dict[str, Any]], filepath: str, s3=None) -> None:
     """
     JSONLファイルを保存する関数(S3対応)
     
@@ -58,7 +91,7 @@ def save_jsonl(data: List[Dict[str, Any]], filepath: str, s3=s3) -> None:
         print(filepath, bucket, key)
         
         # S3にアップロード
-        s3.put_object(
+        (s3 or get_s3_client()).put_object(
             Bucket=bucket,
             Key=key,
             Body=jsonl_content.encode('utf-8')
@@ -70,6 +103,276 @@ def save_jsonl(data: List[Dict[str, Any]], filepath: str, s3=s3) -> None:
             f.write(jsonl_content)
 
 
+def _split_s3_path(s3_path: str) -> tuple[str, str]:
+    """s3://bucket/key 形式のパスを (bucket, key) に分割する"""
+    path_parts = s3_path.replace('s3://', '').split('/', 1)
+    return path_parts[0], path_parts[1] if len(path_parts) > 1 else ''
+
+
+class CrawlJournal:
+    """
+    産駒ごとのレース取得完了(horse_id→馬名)を追記していくチェックポイント
+
+    取得のたびに horse_names.json 全体を書き直す代わりに、完了した1頭分だけを
+    ジャーナルへ追記し、最後（または再開時）に horse_names.json へまとめる(compact)。
+    - ローカル: races/horse_names.journal に1行ずつ追記
+    - S3: 追記ができないため flush_every 頭ごと（既定は1頭ごと）に races/_journal/ 以下へ小さなオブジェクトとして書き出す
+      （強制終了された場合に取り直しになるのは、書き出す前の flush_every - 1 頭まで）
+    ※ 拡張子を .jsonl にしないのは、レースファイルの一覧に混ざらないようにするため
+
+    Args:
+        races_dir: レースデータの保存先ディレクトリ(ローカルまたはs3://bucket/prefix形式)
+        flush_every: S3の場合に何頭ごとにジャーナルを書き出すか
+    """
+
+    def __init__(self, races_dir: str, flush_every: int = 1, s3=None):
+        self.races_dir = races_dir.rstrip('/')
+        self.names_path = f"{self.races_dir}/horse_names.json"
+        self.use_s3 = races_dir.startswith('s3://')
+        self.flush_every = flush_every
+        self.s3 = (s3 or get_s3_client()) if self.use_s3 else None
+        self.horse_names: Dict[str, str] = {}
+        self._buffer: List[tuple[str, str]] = []
+        self._journal_keys: List[str] = []
+        self._pending = False
+        if self.use_s3:
+            self.bucket, prefix = _split_s3_path(self.races_dir)
+            self.journal_prefix = f"{prefix}/_journal/"
+        else:
+            self.journal_path = os.path.join(self.races_dir, "horse_names.journal")
+
+    def load(self) -> Dict[str, str]:
+        """horse_names.json とジャーナルを合わせた取得済みの horse_id→馬名 を返す"""
+        self.horse_names = {}
+        self._journal_keys = []
+        lines = []
+        if self.use_s3:
+            _, names_key = _split_s3_path(self.names_path)
+            try:
+                response = self.s3.get_object(Bucket=self.bucket, Key=names_key)
+                self.horse_names = json.loads(response['Body'].read().decode('utf-8'))
+            except self.s3.exceptions.NoSuchKey:
+                pass
+            for obj in iter_s3_objects(self.bucket, self.journal_prefix, s3=self.s3):
+                self._journal_keys.append(obj['Key'])
+            for journal_key in sorted(self._journal_keys):
+                response = self.s3.get_object(Bucket=self.bucket, Key=journal_key)
+                lines.extend(response['Body'].read().decode('utf-8').splitlines())
+        else:
+            if os.path.exists(self.names_path):
+                with open(self.names_path, "r", encoding="utf-8") as f:
+                    self.horse_names = json.load(f)
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断時に書きかけだった行は無視する
+                continue
+            self.horse_names[entry["horse_id"]] = entry["horse_name"]
+        self._pending = bool(lines)
+        return self.horse_names
+
+    def has_pending(self) -> bool:
+        """compactされていないジャーナルがある（＝前回の取得が中断された）か"""
+        return self._pending or bool(self._buffer)
+
+    def append(self, horse_id: str, horse_name: str) -> None:
+        """1頭分の取得完了を記録する"""
+        self.horse_names[horse_id] = horse_name
+        self._pending = True
+        if self.use_s3:
+            self._buffer.append((horse_id, horse_name))
+            if len(self._buffer) >= self.flush_every:
+                self.flush()
+        else:
+            Path(self.journal_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"horse_id": horse_id, "horse_name": horse_name}, ensure_ascii=False) + "\n")
+
+    def flush(self) -> None:
+        """S3の場合、バッファ中の記録をジャーナルオブジェクトとして書き出す"""
+        if not self.use_s3 or not self._buffer:
+            return
+        journal_key = f"{self.journal_prefix}{time.time_ns():020d}.journal"
+        body = "\n".join(
+            json.dumps({"horse_id": horse_id, "horse_name": horse_name}, ensure_ascii=False)
+            for horse_id, horse_name in self._buffer
+        )
+        self.s3.put_object(Bucket=self.bucket, Key=journal_key, Body=body.encode('utf-8'))
+        self._journal_keys.append(journal_key)
+        self._buffer = []
+
+    def compact(self) -> None:
+        """ジャーナルの内容を horse_names.json にまとめ、ジャーナルを削除する"""
+        content = json.dumps(self.horse_names, ensure_ascii=False, indent=4)
+        if self.use_s3:
+            save_txt(content, self.names_path, s3=self.s3)
+            # 1頭ごとのジャーナルは数が多くなるため、まとめて削除する（1回のリクエストで最大1000件）
+            for start in range(0, len(self._journal_keys), 1000):
+                self.s3.delete_objects(Bucket=self.bucket, Delete={
+                    "Objects": [{"Key": journal_key} for journal_key in self._journal_keys[start:start + 1000]],
+                    "Quiet": True,
+                })
+            self._journal_keys = []
+            self._buffer = []
+        else:
+            save_txt(content, self.names_path)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        self._pending = False
+
+
+class S3ObjectCache:
+    """
+    S3のオブジェクトをローカルディスクに保存しておく読み込み用のキャッシュ(LRU)
+
+    プロセス内の全Streamlitセッションで共有する。キャッシュ済みのオブジェクトは
+    - version（カタログのマニフェストの更新日時など）が一致すれば、通信せずにそのまま使う
+    - version が指定されていないか一致しない場合は、HEADでETagを確認し、変わっていなければそのまま使う
+    合計サイズが max_bytes を超えたら、参照が古いものから削除する
+
+    Args:
+        cache_dir: キャッシュの保存先ディレクトリ
+        max_bytes: キャッシュの最大合計サイズ(バイト)
+    """
+
+    def __init__(self, cache_dir: str = "cache/s3", max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # digest → サイズ（古い順）
+        self._total = 0
+        self._loaded = False
+
+    def _load_index(self) -> None:
+        # 既存のキャッシュを最終参照時刻の古い順に並べてLRUの順序を復元する
+        files = []
+        for data_path in self.cache_dir.glob("*/*.bin"):
+            try:
+                stat = data_path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, data_path.stem, stat.st_size))
+        for _, digest, size in sorted(files):
+            self._entries[digest] = size
+            self._total += size
+        self._loaded = True
+
+    def _paths(self, digest: str) -> tuple[Path, Path]:
+        base = self.cache_dir / digest[:2] / digest
+        return base.with_suffix(".bin"), base.with_suffix(".json")
+
+    def get(self, bucket: str, key: str, version: str | None = None, s3=None) -> bytes:
+        """オブジェクトの中身を返す（キャッシュが有効でなければS3から取得してキャッシュする）"""
+        s3 = s3 or get_s3_client()
+        digest = hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+        data_path, meta_path = self._paths(digest)
+        with self._lock:
+            if not self._loaded:
+                self._load_index()
+            cached = digest in self._entries
+
+        if cached:
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+                if version is None or meta.get("version") != version:
+                    try:
+                        etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+                    except s3.exceptions.ClientError:
+                        etag = None
+                    if etag is None or etag != meta.get("etag"):
+                        raise LookupError
+                    if version is not None:
+                        meta["version"] = version
+                        meta_path.write_text(json.dumps(meta), encoding="utf-8")
+                content = data_path.read_bytes()
+                os.utime(data_path)
+                with self._lock:
+                    self._entries.move_to_end(digest)
+                return content
+            except (OSError, ValueError, LookupError):
+                pass
+
+        response = s3.get_object(Bucket=bucket, Key=key)
+        content = response['Body'].read()
+        self._put(digest, content, {"bucket": bucket, "key": key, "etag": response.get('ETag'), "version": version})
+        return content
+
+    def _put(self, digest: str, content: bytes, meta: dict) -> None:
+        data_path, meta_path = self._paths(digest)
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = data_path.with_suffix(f".tmp{threading.get_ident()}")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, data_path)
+        meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+        with self._lock:
+            self._total += len(content) - self._entries.pop(digest, 0)
+            self._entries[digest] = len(content)
+            evicted = []
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_digest, size = self._entries.popitem(last=False)
+                self._total -= size
+                evicted.append(old_digest)
+        for old_digest in evicted:
+            for path in self._paths(old_digest):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+
+# プロセス内で共有するS3オブジェクトのキャッシュ
+s3_object_cache = S3ObjectCache()
+
+
+def read_s3_bytes(s3_path: str, version: str | None = None, s3=None) -> bytes:
+    """s3://bucket/key のオブジェクトをローカルのキャッシュ経由で読み込む"""
+    bucket, key = _split_s3_path(s3_path)
+    return s3_object_cache.get(bucket, key, version=version, s3=s3)
+
+
+def iter_s3_objects(bucket: str, prefix: str, delimiter: str | None = None, s3=None) -> Iterator[Dict[str, Any]]:
+    """
+    プレフィックス以下のオブジェクトを全ページ分、1件ずつ遅延して返す
+    （list_objects_v2 の1回あたり1,000件の上限で途中が欠けることはない）
+
+    Args:
+        bucket: S3バケット名
+        prefix: 列挙するプレフィックス
+        delimiter: 指定した場合、それ以降が共通のキーはまとめられ（CommonPrefixes）、返されない
+    """
+    paginator = (s3 or get_s3_client()).get_paginator('list_objects_v2')
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        params["Delimiter"] = delimiter
+    for page in paginator.paginate(**params):
+        yield from page.get('Contents', [])
+
+
+def iter_race_file_paths(races_dir: str, s3=None) -> Iterator[str]:
+    """産駒ごとのレースファイル(races/*.jsonl)のパスを、一覧の取得と並行して1件ずつ返す(S3対応)"""
+    if races_dir.startswith('s3://'):
+        bucket, prefix = _split_s3_path(races_dir)
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        # races/ 直下のみ（_journal/ などのサブディレクトリは含めない）
+        for obj in iter_s3_objects(bucket, prefix, delimiter='/', s3=s3):
+            if obj['Key'].endswith('.jsonl'):
+                yield f"s3://{bucket}/{obj['Key']}"
+    else:
+        yield from glob.glob(os.path.join(races_dir, "*.jsonl"))
+
+
+# compact_sire_to_parquet で作成する列指向ファイル
+SIRE_PARQUET = "sire.parquet"
+RACES_PARQUET = "races.parquet"
+
+
 def build_horse_dict(data_dir: str | Path = None, 
                      use_s3: bool = True, 
                      bucket: str = 'keiba-blood-analyzer-storage', 
@@ -90,33 +393,20 @@ def build_horse_dict(data_dir: str | Path = None,
     
     if use_s3:
         # S3から読み込む場合
-        paginator = s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
-        
-        for page in pages:
-            # 各馬のディレクトリ（CommonPrefixes）を取得
-            for common_prefix in page.get('CommonPrefixes', []):
-                horse_prefix = common_prefix['Prefix']
-                horse_id = horse_prefix.rstrip('/').split('/')[-1]
-                
-                # .txtファイルを探す
-                txt_response = s3.list_objects_v2(Bucket=bucket, Prefix=horse_prefix, Delimiter='/')
-                txt_files = [obj['Key'] for obj in txt_response.get('Contents', []) if obj['Key'].endswith('.txt')]
-                
-                if not txt_files:
-                    continue
-                
-                txt_key = txt_files[0]
-                horse_name = os.path.splitext(os.path.basename(txt_key))[0]
-                
-                result[horse_name] = {
-                    "base_dir": f"s3://{bucket}/{horse_prefix}",
-                    "horse_id": horse_id,
-                    "sire_horse_name": f"s3://{bucket}/{txt_key}",
-                    "sire_horses_file": f"s3://{bucket}/{horse_prefix}{horse_id}.jsonl",
-                    "races_dir": f"s3://{bucket}/{horse_prefix}races/",
-                    "race_horse_names": f"s3://{bucket}/{horse_prefix}races/horse_names.json",
-                }
+        # races/ 以下（産駒ごとのレースファイル）は区切り文字でまとめさせ、
+        # 1回のプレフィックス走査で各種牡馬ディレクトリ直下のファイルだけを列挙する
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        txt_keys = {}
+        for obj in iter_s3_objects(bucket, prefix, delimiter='/races/'):
+            parts = obj['Key'][len(prefix):].split('/')
+            # {sire_id}/{馬名}.txt のみを対象にする（各ディレクトリで最初の.txtを使う）
+            if len(parts) == 2 and parts[1].endswith('.txt') and parts[0] not in txt_keys:
+                txt_keys[parts[0]] = obj['Key']
+
+        for horse_id, txt_key in txt_keys.items():
+            horse_name = os.path.splitext(os.path.basename(txt_key))[0]
+            result[horse_name] = _sire_entry(f"s3://{bucket}/{prefix.rstrip('/')}", horse_id, horse_name)
     else:
         # ローカルから読み込む場合
         if data_dir is None:
@@ -141,68 +431,289 @@ def build_horse_dict(data_dir: str | Path = None,
             
             horse_id = horse_dir.name
             
-            result[horse_name] = {
-                "base_dir": str(horse_dir),
-                "horse_id": horse_id,
-                "sire_horse_name": str(txt_path),
-                "sire_horses_file": str(horse_dir / f"{horse_id}.jsonl"),
-                "races_dir": str(horse_dir / "races"),
-                "race_horse_names": str(horse_dir / "races" / "horse_names.json"),
-            }
+            result[horse_name] = _sire_entry(str(data_dir), horse_id, horse_name)
     
     return result
 
-def fetch_text_from_rawdata(result):
-  data = []
-  for raw in result:
-    raw_data = {}
-    for key, value in raw['_raw'].items():
-    #   列名の余計な表記を削除
-      if ' ↑ ↓' in key:
-        key = key.replace(' ↑ ↓','').replace(' ','').strip()
-
-      if isinstance(value, dict):
-        if 'text' in value:
-          text = value['text']
-          if text != '':
-            raw_data[key] = text
-    data.append(raw_data)
-  return data
-
-def read_jsonl(jsonl_path: str, s3=s3) -> pd.DataFrame:
+
+def _sire_entry(data_root: str, horse_id: str, horse_name: str) -> Dict[str, str]:
+    """build_horse_dict の値（種牡馬1頭分の各ファイルのパス）を組み立てる"""
+    if data_root.startswith('s3://'):
+        base_dir = f"{data_root}/{horse_id}/"
+        return {
+            "base_dir": base_dir,
+            "horse_id": horse_id,
+            "sire_horse_name": f"{base_dir}{horse_name}.txt",
+            "sire_horses_file": f"{base_dir}{horse_id}.jsonl",
+            "races_dir": f"{base_dir}races/",
+            "race_horse_names": f"{base_dir}races/horse_names.json",
+            "sire_parquet": f"{base_dir}{SIRE_PARQUET}",
+            "races_parquet": f"{base_dir}{RACES_PARQUET}",
+        }
+    horse_dir = Path(data_root) / horse_id
+    return {
+        "base_dir": str(horse_dir),
+        "horse_id": horse_id,
+        "sire_horse_name": str(horse_dir / f"{horse_name}.txt"),
+        "sire_horses_file": str(horse_dir / f"{horse_id}.jsonl"),
+        "races_dir": str(horse_dir / "races"),
+        "race_horse_names": str(horse_dir / "races" / "horse_names.json"),
+        "sire_parquet": str(horse_dir / SIRE_PARQUET),
+        "races_parquet": str(horse_dir / RACES_PARQUET),
+    }
+
+
+# 保存済みの種牡馬の一覧（データのルートディレクトリ直下に置く）
+MANIFEST_FILE = "manifest.json"
+
+
+def manifest_path(data_root: str) -> str:
+    """データのルートディレクトリ(data または s3://bucket/data)からマニフェストのパスを返す"""
+    return f"{data_root.rstrip('/')}/{MANIFEST_FILE}"
+
+
+def _empty_manifest() -> Dict[str, Any]:
+    return {"version": 0, "updated_at": None, "sires": {}}
+
+
+def _read_manifest_with_etag(path: str, s3=None) -> tuple[Dict[str, Any], str | None]:
+    if path.startswith('s3://'):
+        s3 = s3 or get_s3_client()
+        bucket, key = _split_s3_path(path)
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key)
+        except s3.exceptions.NoSuchKey:
+            return _empty_manifest(), None
+        return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+    if not os.path.exists(path):
+        return _empty_manifest(), None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f), None
+
+
+def load_manifest(data_root: str = "s3://keiba-blood-analyzer-storage/data", s3=None) -> Dict[str, Any]:
     """
-    JSONLファイルを読み込む関数(S3対応)
-    
+    種牡馬カタログのマニフェストを1回の読み込みで取得する
+
+    Returns:
+        {
+          "version": 更新のたびに1ずつ増える番号,
+          "updated_at": 最終更新日時,
+          "sires": {sire_id: {"name", "horse_count", "race_count", "updated_at"}}
+        }
+        マニフェストがまだない場合は version=0 の空のマニフェスト
+    """
+    return _read_manifest_with_etag(manifest_path(data_root), s3=s3)[0]
+
+
+def scan_manifest_sires(data_root: str) -> Dict[str, Dict[str, Any]]:
+    """ディレクトリを走査して、保存済みの種牡馬をマニフェストの sires の形式で返す"""
+    if data_root.startswith('s3://'):
+        bucket, prefix = _split_s3_path(data_root.rstrip('/') + '/')
+        horse_dict = build_horse_dict(bucket=bucket, prefix=prefix)
+    else:
+        horse_dict = build_horse_dict(data_root, use_s3=False)
+    return {entry["horse_id"]: {"name": name} for name, entry in horse_dict.items()}
+
+
+def _modify_manifest(data_root: str, modify: Callable[[Dict[str, Any]], None], s3=None, max_retries: int = 10) -> Dict[str, Any]:
+    """
+    マニフェストを読み込んで modify で書き換え、versionを1つ進めて保存する
+
+    複数のプロセスから同時に更新されても取りこぼさないよう、
+    S3では条件付き書き込み(If-Match / If-None-Match)、ローカルではファイルロックと置き換えで原子的に更新する
+    """
+    path = manifest_path(data_root)
+
+    def _apply(manifest):
+        now = pd.Timestamp.now(tz='Asia/Tokyo').isoformat()
+        manifest.setdefault("sires", {})
+        modify(manifest)
+        manifest["version"] = manifest.get("version", 0) + 1
+        manifest["updated_at"] = now
+        return json.dumps(manifest, ensure_ascii=False, indent=4)
+
+    if path.startswith('s3://'):
+        s3 = s3 or get_s3_client()
+        bucket, key = _split_s3_path(path)
+        for _ in range(max_retries):
+            manifest, etag = _read_manifest_with_etag(path, s3=s3)
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                s3.put_object(Bucket=bucket, Key=key, Body=_apply(manifest).encode('utf-8'), **condition)
+                return manifest
+            except s3.exceptions.ClientError as e:
+                # 他のプロセスが先に更新した場合は読み直してやり直す
+                if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+        raise RuntimeError(f"マニフェストの更新が競合し続けました: {path}")
+
+    import fcntl
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest, _ = _read_manifest_with_etag(path)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(_apply(manifest))
+        os.replace(tmp_path, path)
+    return manifest
+
+
+def update_manifest(data_root: str, sire_id: str, sire_info: Dict[str, Any], s3=None, max_retries: int = 10) -> Dict[str, Any]:
+    """
+    マニフェストの種牡馬1頭分を更新し、versionを1つ進める
+
+    マニフェストがまだない場合は、ディレクトリを走査して保存済みの種牡馬を登録してから更新する
+    （マニフェストができると一覧はマニフェストだけから作るため、それ以前に保存した種牡馬が消えないようにする）
+
     Args:
-        jsonl_path: 読み込むファイルパス(ローカルまたはs3://bucket/key形式)
-    
+        data_root: データのルートディレクトリ(data または s3://bucket/data)
+        sire_id: 種牡馬ID
+        sire_info: name, horse_count, race_count など（updated_at は自動で設定する）
+    """
+    scanned = {}
+
+    def _modify(manifest):
+        if manifest.get("version", 0) == 0:
+            if not scanned:
+                scanned.update(scan_manifest_sires(data_root))
+            for scanned_id, info in scanned.items():
+                manifest["sires"].setdefault(scanned_id, dict(info))
+        now = pd.Timestamp.now(tz='Asia/Tokyo').isoformat()
+        manifest["sires"][sire_id] = {**manifest["sires"].get(sire_id, {}), **sire_info, "updated_at": now}
+
+    return _modify_manifest(data_root, _modify, s3=s3, max_retries=max_retries)
+
+
+def rebuild_manifest(data_root: str, s3=None) -> int:
+    """
+    ディレクトリを走査して、マニフェストにない保存済みの種牡馬を追加する（既にある種牡馬の情報は変えない）
+
     Returns:
-        読み込んだデータのDataFrame
+        追加した種牡馬の数
     """
-    data = []
-    
+    scanned = scan_manifest_sires(data_root)
+    added = []
+
+    def _modify(manifest):
+        added.clear()
+        for sire_id, info in scanned.items():
+            if sire_id not in manifest["sires"]:
+                manifest["sires"][sire_id] = dict(info)
+                added.append(sire_id)
+
+    _modify_manifest(data_root, _modify, s3=s3)
+    return len(added)
+
+
+def find_sire_name(base_dir: str, s3=None) -> str | None:
+    """種牡馬の保存先ディレクトリ直下の {馬名}.txt から種牡馬名を返す(S3対応)"""
+    if base_dir.startswith('s3://'):
+        bucket, prefix = _split_s3_path(base_dir.rstrip('/') + '/')
+        txt_keys = (obj['Key'] for obj in iter_s3_objects(bucket, prefix, delimiter='/', s3=s3))
+    else:
+        txt_keys = (str(p) for p in sorted(Path(base_dir).glob("*.txt")))
+    for txt_key in txt_keys:
+        if txt_key.endswith('.txt'):
+            return os.path.splitext(os.path.basename(txt_key))[0]
+    return None
+
+
+def build_horse_dict_from_manifest(manifest: Dict[str, Any], data_root: str = "s3://keiba-blood-analyzer-storage/data") -> dict:
+    """マニフェストから build_horse_dict と同じ形式の辞書を作る（ディレクトリの走査をしない）"""
+    result = {}
+    for sire_id, info in sorted(manifest.get("sires", {}).items()):
+        entry = _sire_entry(data_root.rstrip('/'), sire_id, info["name"])
+        entry["version"] = info.get("updated_at")
+        result[info["name"]] = entry
+    return result
+
+
+# 列名のキャッシュ（同じ列名が全行に出てくるため、整形は1回だけにする）
+_raw_key_cache: Dict[str, str] = {}
+
+
+def _clean_raw_key(key: str) -> str:
+    cleaned = _raw_key_cache.get(key)
+    if cleaned is None:
+        # 列名の余計な表記を削除
+        cleaned = key.replace(' ↑ ↓', '').replace(' ', '').strip() if ' ↑ ↓' in key else key
+        _raw_key_cache[key] = cleaned
+    return cleaned
+
+
+def _text_fields(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """_raw の各セルから空でない text だけを取り出す"""
+    return {
+        _clean_raw_key(key): value['text']
+        for key, value in raw.items()
+        if isinstance(value, dict) and value.get('text', '') != ''
+    }
+
+
+def fetch_text_from_rawdata(result):
+    return [_text_fields(raw['_raw']) for raw in result]
+
+
+def _iter_jsonl_lines(jsonl_path: str, s3=None, version: str | None = None) -> Iterator[bytes]:
+    """JSONLファイルの空でない行をbytesのまま1行ずつ返す（全体を文字列にデコードしない）"""
     if jsonl_path.startswith('s3://'):
-        # S3パスをパース
-        path_parts = jsonl_path.replace('s3://', '').split('/', 1)
-        bucket = path_parts[0]
-        key = path_parts[1] if len(path_parts) > 1 else ''
-        
-        # S3からデータを取得
-        response = s3.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        
-        for line in content.strip().split('\n'):
-            if line:
-                data.append(json.loads(line))
+        # S3からデータを取得（ローカルキャッシュ経由）
+        content = read_s3_bytes(jsonl_path, version=version, s3=s3)
+        for line in content.splitlines():
+            if line.strip():
+                yield line
     else:
         print("ローカルファイル読み込み:")
         # ローカルファイルから読み込み
         if os.path.exists(jsonl_path):
-            with open(jsonl_path, 'r', encoding='utf-8') as f:
+            with open(jsonl_path, 'rb') as f:
                 for line in f:
-                    data.append(json.loads(line.strip()))
+                    if line.strip():
+                        yield line
+
+
+def parse_text_records(lines: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    """JSONLの各行をデコードし、同じループで _raw の text だけのレコードにして返す"""
+    for line in lines:
+        yield _text_fields(_json_loads(line)['_raw'])
+
+
+def read_jsonl_records(jsonl_path: str, s3=None, version: str | None = None) -> List[Dict[str, Any]]:
+    """
+    JSONLファイルを読み込み、各行のdictのリストを返す関数(S3対応)
+    
+    Args:
+        jsonl_path: 読み込むファイルパス(ローカルまたはs3://bucket/key形式)
+        version: S3の場合、ローカルキャッシュの有効性の確認に使うバージョン(S3ObjectCache参照)
+    
+    Returns:
+        読み込んだレコードのリスト(_rawを含む保存時のままの形式)
+    """
+    return [_json_loads(line) for line in _iter_jsonl_lines(jsonl_path, s3=s3, version=version)]
+
+
+def read_text_records(jsonl_path: str, s3=None, version: str | None = None) -> List[Dict[str, Any]]:
+    """
+    JSONLファイルを読み込み、_raw の text だけのレコードのリストを返す関数(S3対応)
+    （read_jsonl_records + fetch_text_from_rawdata と同じ結果を、中間のdictのリストを作らずに得る）
+    """
+    return list(parse_text_records(_iter_jsonl_lines(jsonl_path, s3=s3, version=version)))
+
+
+def read_jsonl(jsonl_path: str, s3=None, version: str | None = None) -> pd.DataFrame:
+    """
+    JSONLファイルを読み込む関数(S3対応)
     
-    return pd.DataFrame(fetch_text_from_rawdata(data))
+    Args:
+        jsonl_path: 読み込むファイルパス(ローカルまたはs3://bucket/key形式)
+        version: S3の場合、ローカルキャッシュの有効性の確認に使うバージョン(S3ObjectCache参照)
+    
+    Returns:
+        読み込んだデータのDataFrame
+    """
+    return pd.DataFrame(read_text_records(jsonl_path, s3=s3, version=version))
 
 def clean_sire_horse_df(df):
    df['生年'] = pd.to_numeric(df['生年'], errors='coerce')
@@ -212,8 +723,36 @@ def clean_sire_horse_df(df):
    return df
 
 
-response = s3.get_object(Bucket=bucket_name, Key=key)
-field_info = json.loads(response['Body'].read().decode('utf-8'))
+# 競馬場の情報（{"地方" or "中央": {競馬場名: カーブ}}）
+# パッケージ同梱の既定値を使い、環境変数 FIELD_INFO_PATH（ローカルまたはs3://bucket/key形式）を指定した場合だけそちらで上書きする
+# （例: FIELD_INFO_PATH=s3://keiba-blood-analyzer-storage/data/field_info.json）
+DEFAULT_FIELD_INFO_FILE = Path(__file__).with_name("field_info.json")
+FIELD_INFO_PATH = os.environ.get("FIELD_INFO_PATH", "")
+
+_field_info = None
+_field_info_lock = threading.Lock()
+
+
+def get_field_info() -> Dict[str, Dict[str, str]]:
+    """競馬場の情報を初回呼び出し時に読み込んで返す（以降は読み込み済みのものを返す）"""
+    global _field_info
+    if _field_info is None:
+        with _field_info_lock:
+            if _field_info is None:
+                with open(DEFAULT_FIELD_INFO_FILE, "r", encoding="utf-8") as f:
+                    field_info = json.load(f)
+                if FIELD_INFO_PATH:
+                    try:
+                        if FIELD_INFO_PATH.startswith('s3://'):
+                            field_info = json.loads(read_s3_bytes(FIELD_INFO_PATH).decode('utf-8'))
+                        else:
+                            with open(FIELD_INFO_PATH, "r", encoding="utf-8") as f:
+                                field_info = json.load(f)
+                    except Exception as e:
+                        # オフライン・認証情報なしの場合などは同梱の既定値を使う
+                        print(f"{FIELD_INFO_PATH} が読み込めないため同梱の競馬場情報を使います: {e}")
+                _field_info = field_info
+    return _field_info
 
 
 def judge_distance_category(distance: int) -> str:
@@ -227,47 +766,156 @@ def judge_distance_category(distance: int) -> str:
         return "2400~3000"
 
 
+# レース名に含まれるキーワードからクラスを決める規則（上にあるものほど優先する）
+RACE_TIER_RULES = [
+    ("G1", ["(ＧⅠ)", "(GI)", "G1", "Jpn1"]),
+    ("G2", ["(ＧⅡ)", "(GII)", "G2", "Jpn2"]),
+    ("G3", ["(ＧⅢ)", "(GIII)", "G3", "Jpn3"]),
+    ("OP", ["オープン", "OP", "Open", "特別", "Ｓ", "S"]),
+    ("L", ["L"]),
+    ("新馬・未勝利", ["未勝利", "新馬"]),
+    ("1勝クラス", ["1勝クラス", "500万"]),
+    ("2勝クラス", ["2勝クラス", "1000万"]),
+    ("3勝クラス", ["3勝クラス", "1600万"]),
+    ("重賞", ["重賞"]),
+]
+RACE_TIER_DEFAULT = "その他"
+
+
 def categorize_race_tier(race_name: str) -> str:
     if not isinstance(race_name, str):
-        return "その他"
-    
-    if any(keyword in race_name for keyword in ["(ＧⅠ)", "(GI)", "G1", "Jpn1"]):
-        return "G1"
-    elif any(keyword in race_name for keyword in ["(ＧⅡ)", "(GII)", "G2", "Jpn2"]):
-        return "G2"
-    elif any(keyword in race_name for keyword in ["(ＧⅢ)", "(GIII)", "G3", "Jpn3"]):
-        return "G3"
-    elif any(keyword in race_name for keyword in ["オープン", "OP", "Open", "特別", "Ｓ", "S"]):
-        return "OP"
-    elif any(keyword in race_name for keyword in ["L"]):
-        return "L"
-    elif any(keyword in race_name for keyword in ["未勝利", "新馬"]):
-        return "新馬・未勝利"
-    elif "1勝クラス" in race_name or "500万" in race_name:
-        return "1勝クラス"
-    elif "2勝クラス" in race_name or "1000万" in race_name:
-        return "2勝クラス"
-    elif any(keyword in race_name for keyword in ["3勝クラス", "1600万"]):
-        return "3勝クラス"
-    elif "重賞" in race_name:
-        return "重賞"
-    else:
-        return "その他"
+        return RACE_TIER_DEFAULT
+    for tier, keywords in RACE_TIER_RULES:
+        if any(keyword in race_name for keyword in keywords):
+            return tier
+    return RACE_TIER_DEFAULT
+
+
+class RaceClassResolver:
+    """
+    レース名→クラスの対応を、ユニークなレース名ごとに1回だけ判定してキャッシュする
+
+    全キーワードを優先順に並べた1つの正規表現で、レース名の各位置から一致するキーワードを先読みで拾い、
+    最も優先度の高いクラスを採用する（categorize_race_tier と同じ結果になる）
+    判定結果は cache_path に保存し、種牡馬・セッション・プロセスをまたいで使い回す
+    （RACE_TIER_RULES を変えた場合はキャッシュを作り直す）
+
+    Args:
+        cache_path: 判定結果の保存先(JSON)。Noneの場合はメモリ上にのみ持つ
+    """
+
+    def __init__(self, cache_path: str | None = "cache/race_class.json"):
+        self.cache_path = Path(cache_path) if cache_path else None
+        keywords = [(keyword, priority) for priority, (_, kws) in enumerate(RACE_TIER_RULES) for keyword in kws]
+        self._priority = dict(reversed(keywords))
+        # 同じ位置から複数のキーワードが一致する場合は、優先度の高い（先に書いた）方が選ばれる
+        self._pattern = re.compile("(?=(" + "|".join(re.escape(keyword) for keyword, _ in keywords) + "))")
+        self._rules_version = hashlib.sha256(
+            json.dumps(RACE_TIER_RULES, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        self._lock = threading.Lock()
+        self._classes: Dict[str, str] | None = None
+
+    def _load(self) -> Dict[str, str]:
+        if self.cache_path is not None and self.cache_path.exists():
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    cached = json.load(f)
+                if cached.get("rules_version") == self._rules_version:
+                    return cached["classes"]
+            except (OSError, ValueError, KeyError):
+                pass
+        return {}
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"rules_version": self._rules_version, "classes": self._classes}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def categorize(self, race_name: str) -> str:
+        """レース名1つのクラスを判定する（キャッシュは使わない）"""
+        priorities = [self._priority[keyword] for keyword in self._pattern.findall(race_name)]
+        return RACE_TIER_RULES[min(priorities)][0] if priorities else RACE_TIER_DEFAULT
+
+    def resolve(self, race_names: pd.Series) -> pd.Series:
+        """レース名の列をクラスの列にする（未判定のユニークなレース名だけを判定する）"""
+        with self._lock:
+            if self._classes is None:
+                self._classes = self._load()
+            unique_names = [name for name in race_names.dropna().unique() if isinstance(name, str)]
+            new_names = [name for name in unique_names if name not in self._classes]
+            if new_names:
+                self._classes.update((name, self.categorize(name)) for name in new_names)
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"レースクラスのキャッシュを保存できませんでした: {e}")
+            classes = {name: self._classes[name] for name in unique_names}
+        # 文字列でないレース名（欠損など）は「その他」
+        return race_names.map(classes).fillna(RACE_TIER_DEFAULT).astype(object)
+
+
+# プロセス内で共有するレースクラスの判定器
+race_class_resolver = RaceClassResolver()
+
+
+# 距離区分・季節の区切り（judge_distance_category と同じ区分）
+DISTANCE_BINS = [(1400, "0800~1400"), (1800, "1400~1800"), (2400, "1800~2400")]
+DISTANCE_LAST_CATEGORY = "2400~3000"
+SEASONS = {"04~06春": [4, 5, 6], "07~09夏": [7, 8, 9], "10~12秋": [10, 11, 12], "01~03冬": [1, 2, 3]}
 
-def clean_race_df(df, field_info=field_info):
+
+def _with_none(s: pd.Series) -> pd.Series:
+    """欠損値をNoneにしたobject型のSeriesにする（applyで作っていた列と同じ形にそろえる）"""
+    s = s.astype(object)
+    return s.where(s.notna(), None)
+
+
+def clean_race_df(df, field_info=None):
+    """
+    レースデータから芝ダート・距離区分・クラス・競馬場・季節などの列を作り、数値列を数値型にする
+
+    行ごとのPython関数呼び出しはせず、文字列アクセサ・np.select と、
+    ユニークな値ごとに作った対応表(競馬場・クラス)で列単位に処理する
+    """
+    field_info = field_info or get_field_info()
     df.rename(columns=lambda x: x.replace(" ", ""), inplace=True)
-    df['芝ダート'] = df['距離'].apply(lambda x: x[0] if isinstance(x, str) and (x[0] == '芝' or x[0] == 'ダ') else None)
-    df['距離_m'] = df['距離'].apply(lambda x: pd.to_numeric(x[1:], errors='coerce') if isinstance(x, str) else None)
-    df['距離区分'] = df['距離_m'].apply(lambda x: judge_distance_category(x) if pd.notnull(x) else None) 
-    df['クラス'] = df['レース名'].apply(lambda x: categorize_race_tier(x))
 
+    distance = df['距離']
+    first_char = distance.str[0]
+    df['芝ダート'] = _with_none(first_char.where(first_char.isin(['芝', 'ダ'])))
+    df['距離_m'] = pd.to_numeric(distance.str[1:], errors='coerce')
+    distance_m = df['距離_m']
+    df['距離区分'] = np.select(
+        [distance_m.isna()] + [distance_m < upper for upper, _ in DISTANCE_BINS],
+        [None] + [category for _, category in DISTANCE_BINS],
+        default=DISTANCE_LAST_CATEGORY,
+    )
+    df['クラス'] = race_class_resolver.resolve(df['レース名'])
+
+    # 競馬場名は開催の文字列に含まれる最初の競馬場（地方→中央の順）。開催のユニークな値ごとに1回だけ探す
     field_names = list(field_info['地方'].keys()) + list(field_info['中央'].keys())
-    df['競馬場'] = df['開催'].apply(lambda x: next((name for name in field_names if isinstance(x, str) and name in x), None))
-    df['競馬場区分'] = df['競馬場'].apply(lambda x: '地方' if x in field_info['地方'] else ('中央' if x in field_info['中央'] else None))
-    df['カーブ'] = df['競馬場'].apply(lambda x: field_info['地方'].get(x) if x in field_info['地方'] else (field_info['中央'].get(x) if x in field_info['中央'] else None))
+    track_lookup = {
+        kaisai: next((name for name in field_names if name in kaisai), None)
+        for kaisai in df['開催'].dropna().unique()
+        if isinstance(kaisai, str)
+    }
+    df['競馬場'] = _with_none(df['開催'].map(track_lookup))
+    # 同じ名前が両方にある場合は地方を優先する
+    df['競馬場区分'] = _with_none(df['競馬場'].map({**{name: '中央' for name in field_info['中央']},
+                                                   **{name: '地方' for name in field_info['地方']}}))
+    df['カーブ'] = _with_none(df['競馬場'].map({**field_info['中央'], **field_info['地方']}))
 
-    df['月'] = df['日付'].apply(lambda x: int(x.split('/')[1]) if isinstance(x, str) else None)
-    df['季節'] = df['月'].apply(lambda x: '04~06春' if x in [4,5,6] else ('07~09夏' if x in [7,8,9] else ('10~12秋' if x in [10,11,12] else ('01~03冬' if x in [1,2,3] else None))))
+    # 欠損がなければ整数、あれば浮動小数になる
+    df['月'] = pd.to_numeric(df['日付'].str.split('/', n=2).str[1])
+    df['季節'] = np.select(
+        [df['月'].isin(months) for months in SEASONS.values()],
+        list(SEASONS.keys()),
+        default=None,
+    )
 
     for num_col in ['R', '頭数', '枠番', '馬番', 'オッズ', '人気', '着順',
        '斤量', '着差','上り', '距離_m']:
@@ -281,60 +929,428 @@ def clean_race_df(df, field_info=field_info):
 
     return df
 
-def read_horse_raw_data(
-    selected_sire_horse_name: str,
-    sire_horse_dict: Dict[str, Dict[str, str]],
-    s3=s3
+# race_record_stats の集計列（件数）
+RACE_RECORD_COUNT_COLUMNS = ["総出走数", "勝利数", "連帯数", "複勝数", "掲示板内数", "二着数", "三着数", "掲示板数"]
+
+
+def add_race_record_rates(stats: pd.DataFrame) -> pd.DataFrame:
+    """集計済みの件数から勝率・連帯率・複勝率・掲示板率(%)の列を追加する"""
+    stats["勝率"] = (stats["勝利数"] / stats["総出走数"] * 100).round(2)
+    stats["連帯率"] = (stats["連帯数"] / stats["総出走数"] * 100).round(2)
+    stats["複勝率"] = (stats["複勝数"] / stats["総出走数"] * 100).round(2)
+    stats["掲示板率"] = (stats["掲示板内数"] / stats["総出走数"] * 100).round(2)
+    return stats
+
+
+def race_record_counts(df_race: pd.DataFrame) -> pd.DataFrame:
+    """1行1レースの着順別の件数（RACE_RECORD_COUNT_COLUMNS の列。着順が欠損しているレースは全て0）"""
+    # nullable 整数型(compact_dtypes)の比較は欠損が<NA>になるため、NaNを持つfloatにして比較する
+    rank = df_race["着順"].astype("float64")
+    return pd.DataFrame({
+        "総出走数": rank.notna().astype("int64"),
+        "勝利数": (rank == 1).astype("int64"),
+        "連帯数": (rank <= 2).astype("int64"),
+        "複勝数": (rank <= 3).astype("int64"),
+        "掲示板内数": (rank <= 5).astype("int64"),
+        "二着数": (rank == 2).astype("int64"),
+        "三着数": (rank == 3).astype("int64"),
+        "掲示板数": ((rank >= 4) & (rank <= 5)).astype("int64"),
+    }, index=df_race.index)
+
+
+def race_record_stats(df_race: pd.DataFrame, groupby_cols: List[str]) -> pd.DataFrame:
+    """
+    条件(groupby_cols)ごとの出走数・着順別の件数と勝率などを集計する
+
+    Returns:
+        groupby_cols + RACE_RECORD_COUNT_COLUMNS + 勝率・連帯率・複勝率・掲示板率 の列のDataFrame（条件の昇順）
+    """
+    # 芝・ダートが欠損しているレースは除く（元のDataFrameに列は追加しない）
+    df_race_clean = df_race[df_race["芝ダート"].notna()]
+    stats = (
+        race_record_counts(df_race_clean)
+        .groupby([df_race_clean[col] for col in groupby_cols], observed=True)
+        .sum()
+        .reset_index()
+    )
+
+    # 勝率、連帯率、複勝率を計算
+    return add_race_record_rates(stats)
+
+
+def sire_data_paths(base_dir: str, sire_id: str) -> Dict[str, str]:
+    """種牡馬の保存先ディレクトリから、build_horse_dict と同じ形式で各ファイルのパスを組み立てる"""
+    return {
+        "base_dir": base_dir,
+        "horse_id": sire_id,
+        "sire_horses_file": os.path.join(base_dir, f"{sire_id}.jsonl"),
+        "races_dir": os.path.join(base_dir, "races"),
+        "race_horse_names": os.path.join(base_dir, "races", "horse_names.json"),
+        "sire_parquet": os.path.join(base_dir, SIRE_PARQUET),
+        "races_parquet": os.path.join(base_dir, RACES_PARQUET),
+    }
+
+
+def load_sire_raw_frames(
+    sire_paths: Dict[str, str],
+    s3=None,
+    max_workers: int = S3_MAX_POOL_CONNECTIONS,
+    on_progress: Callable[[int, int], None] | None = None,
     ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    JSONLから産駒リストとレースデータを読み込む（クリーニング前）
+
+    Args:
+        sire_paths: build_horse_dict の値（または sire_data_paths の戻り値）
+        max_workers: レースファイルを同時に読み込む数
+        on_progress: レースファイルの読み込み進捗 on_progress(読み込み済みの数, 全体の数)
+    
+    Returns:
+        (産駒リスト, horse_id・馬名つきのレースデータ)
+    """
+    # マニフェストから作った辞書であれば、その更新日時でローカルキャッシュを検証する
+    version = sire_paths.get("version")
 
     # 産駒のテーブルデータ読み込み
-    sire_horse_file_path = sire_horse_dict[selected_sire_horse_name]["sire_horses_file"]
-    df_sire = read_jsonl(sire_horse_file_path, s3=s3)
-    df_sire = clean_sire_horse_df(df_sire)
+    sire_records = read_jsonl_records(sire_paths["sire_horses_file"], s3=s3, version=version)
+    df_sire = pd.DataFrame(fetch_text_from_rawdata(sire_records))
+    df_sire["horse_id"] = [record.get("horse_id") for record in sire_records]
 
     # 産駒のID：馬名マッピング辞書の読み込み
-    race_horse_names_path = sire_horse_dict[selected_sire_horse_name]["race_horse_names"]
+    race_horse_names_path = sire_paths["race_horse_names"]
     if race_horse_names_path.startswith('s3://'):
-        # S3パスをパース
-        path_parts = race_horse_names_path.replace('s3://', '').split('/', 1)
-        bucket = path_parts[0]
-        key = path_parts[1] if len(path_parts) > 1 else ''
-        
-        # S3からデータを取得
-        # print(path_parts, bucket, key)
-        response = s3.get_object(Bucket=bucket, Key=key)
-        race_horse_names = json.loads(response['Body'].read().decode('utf-8'))
+        # S3からデータを取得（ローカルキャッシュ経由）
+        race_horse_names = json.loads(read_s3_bytes(race_horse_names_path, version=version, s3=s3).decode('utf-8'))
     else:
         with open(race_horse_names_path, "r", encoding="utf-8") as f:
             race_horse_names = json.load(f)
     
-    # 産駒のレースデータ読み込み
-    race_file_dir = sire_horse_dict[selected_sire_horse_name]["races_dir"]
-    
-    if race_file_dir.startswith('s3://'):
-        # S3パスをパース
-        path_parts = race_file_dir.replace('s3://', '').split('/', 1)
-        bucket = path_parts[0]
-        prefix = path_parts[1] if len(path_parts) > 1 else ''
-        
-        # S3から.jsonlファイルのリストを取得
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        race_file_paths = [f"s3://{bucket}/{obj['Key']}" for obj in response.get('Contents', []) if obj['Key'].endswith('.jsonl')]
+    # 産駒のレースデータ読み込み（一覧の取得が終わるのを待たずに読み込みを始め、最後に1回だけDataFrameにする）
+    race_file_paths = iter_race_file_paths(sire_paths["races_dir"], s3=s3)
+    records = iter_race_records(race_file_paths, race_horse_names, s3=s3,
+                                max_workers=max_workers, on_progress=on_progress, version=version)
+    df_race = pd.DataFrame(list(records))
+    return df_sire, df_race
+
+
+def _race_file_records(race_file_path: str, race_horse_names: Dict[str, str], s3=None,
+                       version: str | None = None) -> List[Dict[str, Any]]:
+    """レースファイル1つ分を、馬名・horse_idつきのフラットなレコードのリストにする"""
+    horse_id = os.path.splitext(os.path.basename(race_file_path.split('/')[-1]))[0]
+    horse_name = race_horse_names.get(horse_id, horse_id)
+    records = read_text_records(race_file_path, s3=s3, version=version)
+    for record in records:
+        record["馬名"] = horse_name
+        record["horse_id"] = horse_id
+    return records
+
+
+def iter_race_records(
+    race_file_paths: Iterable[str],
+    race_horse_names: Dict[str, str],
+    s3=None,
+    max_workers: int = S3_MAX_POOL_CONNECTIONS,
+    on_progress: Callable[[int, int], None] | None = None,
+    version: str | None = None,
+    ) -> Iterator[Dict[str, Any]]:
+    """
+    産駒ごとのレースファイルをスレッドプールで並行して読み込み、1レース分ずつフラットなレコードを返す(S3対応)
+
+    ファイルごとにDataFrameを作って結合する代わりに、呼び出し側で最後に1回だけDataFrameを作れるようにする
+    （総行数に対して線形の時間で読み込める）
+
+    Args:
+        race_file_paths: レースファイル(races/{horse_id}.jsonl)のパス
+            ジェネレータを渡した場合は、1件返されるたびに読み込みを開始する
+        race_horse_names: horse_id→馬名 の辞書（見つからない場合は horse_id を馬名にする）
+        s3: 全スレッドで共有するboto3クライアント（max_pool_connections を max_workers 以上にしておく）
+        max_workers: 同時に読み込むファイル数
+        on_progress: on_progress(読み込み済みの数, 全体の数) の形で呼ばれる
+        version: ローカルキャッシュの有効性の確認に使うバージョン(S3ObjectCache参照)
+
+    Yields:
+        race_file_paths の順（ファイル内は保存順）の、馬名・horse_idつきのレコード
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_race_file_records, path, race_horse_names, s3, version)
+            for path in race_file_paths
+        ]
+        for done, future in enumerate(futures, start=1):
+            yield from future.result()
+            if on_progress is not None:
+                on_progress(done, len(futures))
+
+
+# Parquetに保存する際に数値型にしておくレースデータの列
+RACE_NUMERIC_COLUMNS = ['R', '頭数', '枠番', '馬番', 'オッズ', '人気', '着順', '斤量', '着差', '上り']
+
+
+def _write_parquet(df: pd.DataFrame, filepath: str, s3=None) -> None:
+    """DataFrameをParquet(zstd圧縮)で保存する関数(S3対応)"""
+    if filepath.startswith('s3://'):
+        bucket, key = _split_s3_path(filepath)
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False, compression="zstd")
+        (s3 or get_s3_client()).put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
     else:
-        race_file_paths = glob.glob(os.path.join(race_file_dir, "*.jsonl"))
-    
-    df_race = pd.DataFrame()
-    for race_file_path in race_file_paths:
-        if race_file_path.startswith('s3://'):
-            horse_id = os.path.splitext(os.path.basename(race_file_path.split('/')[-1]))[0]
+        Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(filepath, index=False, compression="zstd")
+
+
+def _read_parquet(filepath: str | None, s3=None, version: str | None = None) -> pd.DataFrame | None:
+    """Parquetファイルを読み込む関数(S3対応・ローカルキャッシュ経由)。ファイルがなければNoneを返す"""
+    if not filepath:
+        return None
+    if filepath.startswith('s3://'):
+        s3 = s3 or get_s3_client()
+        try:
+            content = read_s3_bytes(filepath, version=version, s3=s3)
+        except s3.exceptions.NoSuchKey:
+            return None
+        return pd.read_parquet(io.BytesIO(content))
+    if not os.path.exists(filepath):
+        return None
+    return pd.read_parquet(filepath)
+
+
+def compact_sire_to_parquet(base_dir: str, sire_id: str, s3=None) -> Dict[str, str]:
+    """
+    種牡馬1頭分の産駒リストJSONLとレースJSONL群を、型付き・圧縮済みのParquet 2ファイルにまとめる
+    _raw のリンク情報などは落とし、テキスト（レースの数値列は数値）だけを残す
+
+    Args:
+        base_dir: 種牡馬の保存先ディレクトリ(ローカルまたはs3://bucket/prefix形式)
+        sire_id: 種牡馬ID
+
+    Returns:
+        sire_data_paths の戻り値（作成したParquetのパスを含む）に産駒数(horse_count)・レース数(race_count)を加えたもの
+    """
+    paths = sire_data_paths(base_dir, sire_id)
+    df_sire, df_race = load_sire_raw_frames(paths, s3=s3)
+
+    df_sire = df_sire.astype(str).where(df_sire.notna(), None)
+    df_race.rename(columns=lambda x: x.replace(" ", ""), inplace=True)
+    for col in df_race.columns:
+        if col in RACE_NUMERIC_COLUMNS:
+            df_race[col] = pd.to_numeric(df_race[col], errors='coerce')
         else:
-            horse_id = os.path.splitext(os.path.basename(race_file_path))[0]
-        
-        horse_name = race_horse_names.get(horse_id, horse_id)
-        df_race = pd.concat([
-            df_race,
-            read_jsonl(race_file_path, s3=s3).assign(馬名=horse_name)
-            ],axis=0,ignore_index=True)
-    df_race = clean_race_df(df_race)
-    return df_sire, df_race
+            df_race[col] = df_race[col].astype(str).where(df_race[col].notna(), None)
+
+    _write_parquet(df_sire, paths["sire_parquet"], s3=s3)
+    _write_parquet(df_race, paths["races_parquet"], s3=s3)
+    return {**paths, "horse_count": len(df_sire), "race_count": len(df_race)}
+
+
+# クリーニング処理(clean_sire_horse_df / clean_race_df など)の出力が変わる変更をしたら上げる
+DERIVED_CODE_VERSION = "1"
+
+
+def source_fingerprint(sire_paths: Dict[str, str], s3=None) -> str:
+    """
+    種牡馬1頭分の元データとクリーニング処理のフィンガープリントを返す
+    （いずれかが変わると値が変わる。DerivedDataCache のキーに使う）
+
+    - マニフェストから作った辞書: マニフェストの更新日時（通信なし）
+    - S3: Parquet(なければJSONL群)のETag
+    - ローカル: 各ファイルの更新日時とサイズ
+    """
+    parts = [DERIVED_CODE_VERSION, race_class_resolver._rules_version,
+             json.dumps(get_field_info(), ensure_ascii=False, sort_keys=True)]
+    if sire_paths.get("version"):
+        parts.append(f"version:{sire_paths['version']}")
+    elif sire_paths["base_dir"].startswith('s3://'):
+        s3 = s3 or get_s3_client()
+        etags = []
+        for path in (sire_paths.get("sire_parquet"), sire_paths.get("races_parquet")):
+            bucket, key = _split_s3_path(path)
+            try:
+                etags.append(f"{key}:{s3.head_object(Bucket=bucket, Key=key)['ETag']}")
+            except s3.exceptions.ClientError:
+                break
+        else:
+            parts.extend(etags)
+        if len(etags) < 2:
+            # Parquetがない場合は産駒リストとレースファイル群
+            bucket, prefix = _split_s3_path(sire_paths["base_dir"])
+            for obj in iter_s3_objects(bucket, prefix.rstrip('/') + '/', s3=s3):
+                parts.append(f"{obj['Key']}:{obj['ETag']}")
+    else:
+        files = [sire_paths.get("sire_parquet"), sire_paths.get("races_parquet"),
+                 sire_paths["sire_horses_file"], sire_paths["race_horse_names"]]
+        files += sorted(glob.glob(os.path.join(sire_paths["races_dir"], "*.jsonl")))
+        for path in filter(None, files):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            parts.append(f"{path}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class DerivedDataCache:
+    """
+    クリーニング済みの産駒リスト・レースデータを、元データのフィンガープリントごとにParquetで保存するキャッシュ
+
+    同じプロセスの他のセッションや再起動後の読み込みでは、JSONLの読み込み・クリーニングを丸ごと省略できる
+    種牡馬ごとに最新のフィンガープリントの分だけを残す
+
+    Args:
+        cache_dir: キャッシュの保存先ディレクトリ
+    """
+
+    def __init__(self, cache_dir: str = "cache/derived"):
+        self.cache_dir = Path(cache_dir)
+
+    def _paths(self, sire_id: str, fingerprint: str) -> tuple[Path, Path]:
+        base = self.cache_dir / sire_id
+        return base / f"{fingerprint}.sire.parquet", base / f"{fingerprint}.races.parquet"
+
+    def get(self, sire_id: str, fingerprint: str) -> tuple[pd.DataFrame, pd.DataFrame] | None:
+        sire_path, races_path = self._paths(sire_id, fingerprint)
+        if not (sire_path.exists() and races_path.exists()):
+            return None
+        try:
+            return pd.read_parquet(sire_path), pd.read_parquet(races_path)
+        except Exception as e:
+            print(f"派生データのキャッシュを読み込めませんでした({sire_id}): {e}")
+            return None
+
+    def put(self, sire_id: str, fingerprint: str, df_sire: pd.DataFrame, df_race: pd.DataFrame) -> None:
+        sire_path, races_path = self._paths(sire_id, fingerprint)
+        sire_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            for df, path in ((df_sire, sire_path), (df_race, races_path)):
+                tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}-{threading.get_ident()}")
+                df.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, path)
+        except Exception as e:
+            # 保存できない型の列があってもアプリの読み込みは続ける
+            print(f"派生データのキャッシュを保存できませんでした({sire_id}): {e}")
+            return
+        # 古いフィンガープリントの分を削除する
+        for old_path in sire_path.parent.glob("*.parquet"):
+            if not old_path.name.startswith(fingerprint):
+                try:
+                    old_path.unlink()
+                except OSError:
+                    pass
+
+
+# プロセス内で共有するクリーニング済みデータのキャッシュ
+derived_data_cache = DerivedDataCache()
+
+
+# アプリの絞り込み・集計で使うレースデータの列（compact=True の場合はこれ以外を落とす）
+RACE_ANALYSIS_COLUMNS = [
+    '馬名', 'horse_id', '日付', '開催', 'レース名', '騎手', '馬場', '頭数', '枠番', '馬番', '人気', 'オッズ',
+    '着順', '斤量', '着差', '上り', '芝ダート', '距離_m', '距離区分', 'クラス', '競馬場', '競馬場区分', 'カーブ', '季節',
+]
+# 着順・頭数などの順位・件数の列（欠損があっても小さい整数型にする）
+NULLABLE_INT_COLUMNS = ['着順', '人気', '頭数', '枠番', '馬番']
+# 値の精度が表示に十分なため float32 にする列
+FLOAT32_COLUMNS = ['オッズ', '斤量', '着差', '上り', '距離_m']
+
+
+def _nullable_int_dtype(s: pd.Series) -> str:
+    """欠損のある整数値の列が収まる最小の nullable 整数型"""
+    low, high = s.min(), s.max()
+    for dtype in ("Int8", "Int16", "Int32"):
+        info = np.iinfo(dtype.lower())
+        if pd.isna(low) or (info.min <= low and high <= info.max):
+            return dtype
+    return "Int64"
+
+
+def compact_dtypes(df: pd.DataFrame, keep_columns: List[str] | None = None,
+                   float32_columns: Iterable[str] = FLOAT32_COLUMNS,
+                   nullable_int_columns: Iterable[str] = NULLABLE_INT_COLUMNS,
+                   max_category_ratio: float = 0.5) -> pd.DataFrame:
+    """
+    DataFrameのメモリ使用量を減らす
+
+    - keep_columns 以外の列を落とす（Noneの場合は全て残す）
+    - 文字列の列（object型・string型）は、ユニークな値が行数の max_category_ratio 以下であればカテゴリ型にする
+    - 欠損のない整数値の列は、値が収まる最小の整数型にする
+    - 欠損のある整数値の列のうち nullable_int_columns に含まれるものは、最小の nullable 整数型(Int8/Int16…)にする
+    - それ以外の欠損がある、または小数の列のうち float32_columns に含まれるものは float32 にする
+    """
+    if keep_columns is not None:
+        df = df[[col for col in keep_columns if col in df.columns]]
+    df = df.copy()
+    float32_columns = set(float32_columns)
+    nullable_int_columns = set(nullable_int_columns)
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            if s.nunique(dropna=True) <= len(s) * max_category_ratio:
+                df[col] = s.astype("category")
+        elif pd.api.types.is_bool_dtype(s) or not pd.api.types.is_numeric_dtype(s):
+            continue
+        elif s.notna().all() and (pd.api.types.is_integer_dtype(s) or (s % 1 == 0).all()):
+            df[col] = pd.to_numeric(s.astype("int64"), downcast="integer")
+        elif col in nullable_int_columns and (pd.api.types.is_integer_dtype(s) or (s.dropna() % 1 == 0).all()):
+            df[col] = s.astype(_nullable_int_dtype(s))
+        elif col in float32_columns:
+            df[col] = s.astype("float32")
+    return df
+
+
+def _memory_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
 
+def read_horse_raw_data(
+    selected_sire_horse_name: str,
+    sire_horse_dict: Dict[str, Dict[str, str]],
+    s3=None,
+    max_workers: int = S3_MAX_POOL_CONNECTIONS,
+    on_progress: Callable[[int, int], None] | None = None,
+    compact: bool = False,
+    memory_report: Dict[str, Dict[str, int]] | None = None,
+    use_cache: bool = True,
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    種牡馬1頭分の産駒リストとレースデータを読み込み、クリーニングして返す
+
+    Args:
+        compact: Trueの場合、アプリで使わない列を落とし、カテゴリ型・小さい数値型にしてメモリを減らす(compact_dtypes)
+        memory_report: 渡した場合、段階ごとのメモリ使用量(バイト)を {段階: {"産駒": ..., "レース": ...}} の形で書き込む
+        use_cache: クリーニング済みのデータのキャッシュ(DerivedDataCache)を使う
+    """
+    sire_paths = sire_horse_dict[selected_sire_horse_name]
+
+    def _report(stage):
+        if memory_report is not None:
+            memory_report[stage] = {"産駒": _memory_bytes(df_sire), "レース": _memory_bytes(df_race)}
+
+    # 元データが変わっていなければ、クリーニング済みのデータをキャッシュから読み込む
+    sire_id = sire_paths["horse_id"]
+    fingerprint = source_fingerprint(sire_paths, s3=s3) if use_cache else None
+    cached = derived_data_cache.get(sire_id, fingerprint) if use_cache else None
+    if cached is not None:
+        df_sire, df_race = cached
+        _report("キャッシュ読み込み")
+    else:
+        # Parquetにまとめ済みであれば、それぞれ1回の列指向読み込みで済ませる
+        version = sire_paths.get("version")
+        df_race = _read_parquet(sire_paths.get("races_parquet"), s3=s3, version=version)
+        df_sire = _read_parquet(sire_paths.get("sire_parquet"), s3=s3, version=version) if df_race is not None else None
+        if df_sire is None or df_race is None:
+            df_sire, df_race = load_sire_raw_frames(sire_paths, s3=s3, max_workers=max_workers, on_progress=on_progress)
+        _report("読み込み直後")
+
+        df_sire = clean_sire_horse_df(df_sire)
+        df_race = clean_race_df(df_race)
+        _report("クリーニング後")
+        if use_cache:
+            derived_data_cache.put(sire_id, fingerprint, df_sire, df_race)
+
+    if compact:
+        # 産駒リストは行数が少なく、列をそのまま表示・ピボットするため数値型だけを小さくする
+        df_sire = compact_dtypes(df_sire, float32_columns=[], max_category_ratio=0)
+        df_race = compact_dtypes(df_race, keep_columns=RACE_ANALYSIS_COLUMNS)
+        _report("型の圧縮後")
+    # 読み込んだデータを識別するキー（集計結果のキャッシュのキーなどに使う）
+    df_race.attrs["source_fingerprint"] = fingerprint
+    return df_sire, df_race
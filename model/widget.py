@@ -1,23 +1,23 @@
-import os
 import streamlit as st
 import altair as alt
 import pandas as pd
 from bs4 import BeautifulSoup
 import requests
-import random
 
-import json
 import re
 from urllib.parse import urljoin
-import time
-from typing import List
+import threading
+from collections import OrderedDict
+from typing import Callable, List
 import pandas as pd
 
-from model.scraping import get_response, parse_netkeiba_horse_list_table
-from model.utils import save_jsonl, save_txt
+from model.crawler import (
+    scrape_sire_list, scrape_race_data, scrape_sire, sire_output_dir,
+)
+from model.utils import race_record_stats
+from model.analysis import OTHERS_LABEL, rank_record_groups
 
 import re
-import boto3
 import tempfile
 import shutil
 
@@ -40,143 +40,39 @@ def extract_sire_id(url: str) -> str | None:
     return None
 
 
-def get_sire_name_from_title(text):
-    m = re.search(r"\[父名\](.+?)\s+所属", text)
-    return m.group(1) if m else None
+def _st_progress_callback():
+    """Streamlitのプログレスバーとテキストに進捗を表示するコールバックを返す"""
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    def _on_progress(fraction: float, text: str) -> None:
+        progress_bar.progress(min(max(fraction, 0.0), 1.0))
+        status_text.text(text)
+
+    return _on_progress
+
 
 # 種牡馬の産駒をクローリング
 def st_scraping_sire_data(
     base_url: str,
     max_pages: int | None = 3,
     ):
-
-    sleep_sec: float = 2.0
-    results = []
-    page = 1
-
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
     sire_id = extract_sire_id(base_url)
+    return scrape_sire_list(sire_id, max_pages=max_pages, on_progress=_st_progress_callback())
 
-    while True:
-        if max_pages is not None and page > max_pages:
-            status_text.text(f"max_pages={max_pages} に到達したため終了")
-            break
-        
-        base_url = f'https://db.netkeiba.com/horse/list.html?sire_id={sire_id}&range=all&sort=prize-desc&page=1'
-        url = base_url.replace("page=1", f"page={page}")
-        soup = get_response(url)
-        if soup.title:
-          page_title = soup.title.string
-          sire_horse_name = get_sire_name_from_title(page_title)
-
-        status_text.text(f"{sire_horse_name} のp.{page} を取得中")
-        progress_bar.progress(page / max_pages if max_pages else 0)
-        if soup is not None:
-            result = parse_netkeiba_horse_list_table(soup)
-            results += result
-
-            page += 1
-            time.sleep(sleep_sec)  # アクセス間隔（重要）
-        # 馬一覧テーブルが存在しない（＝これ以上ページがない）
-        else:
-            break
-    progress_bar.progress(1.0)
-    status_text.text(f"取得完了：{page_title} の産駒{len(results)}馬分")
-    return results, sire_horse_name
-    
 
 def st_scraping_race_data(
     sire_results: List[dict],
-    output_dir
-    # horse_id: str,
-    # horse_name: str = None,
+    output_dir,
+    **kwargs,
     ):
-    
-    sleep_sec: float = 5.0
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    horse_names_file = os.path.join(output_dir, "races", "horse_names.json")
-    
-    # S3パスかローカルパスかを判定
-    if horse_names_file.startswith("s3://"):
-        # S3から読み込み
-        try:
-            s3 = boto3.client('s3')
-            # s3://bucket/key形式からバケット名とキーを抽出
-            s3_path = horse_names_file.replace("s3://", "")
-            bucket_name = s3_path.split("/")[0]
-            key = "/".join(s3_path.split("/")[1:])
-            
-            response = s3.get_object(Bucket=bucket_name, Key=key)
-            horse_names = json.loads(response['Body'].read().decode('utf-8'))
-        except s3.exceptions.NoSuchKey:
-            horse_names = {}
-        except Exception:
-            horse_names = {}
-    else:
-        # ローカルから読み込み
-        if not os.path.exists(horse_names_file):
-            horse_names = {}
-        else:
-            with open(horse_names_file, "r", encoding="utf-8") as f:
-                horse_names = json.load(f)
-
-    for i, sire_data in enumerate(sire_results):  # 動作確認のため最初の2頭だけ
-
-        horse_id = sire_data.get("horse_id")
-        output_path = os.path.join(output_dir, "races", f"{horse_id}.jsonl")
-        horse_name = sire_data.get("horse_name")
-        # 既に読み込み済みの場合
-        if not horse_id or horse_id in horse_names:
-            time.sleep(0.05)
-            continue # horse_idがない場合はスキップ
-
-        status_text.text(f"{horse_name} の raceを取得中")
-        progress_bar.progress(i / len(sire_results))
-
-        horse_name = horse_name if horse_name else horse_id
-        url = f"https://db.netkeiba.com/horse/result/{horse_id}/"
-
-        result = None
-
-        soup = get_response(url)
-        if soup is not None:
-            # レース戦績を取得
-            result = parse_netkeiba_horse_list_table(soup,table_summary_desc='の競走戦績')
-
-            save_jsonl(result, output_path)
-
-        horse_names[horse_id] = horse_name
-        time.sleep(random.randrange(2, 4))  # アクセス間隔（重要）
-
-    
-        # horse_names.jsonの保存（S3 or ローカル）
-        if horse_names_file.startswith("s3://"):
-            # S3に保存
-            s3 = boto3.client('s3')
-            s3_path = horse_names_file.replace("s3://", "")
-            bucket_name = s3_path.split("/")[0]
-            key = "/".join(s3_path.split("/")[1:])
-            
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=key,
-                Body=json.dumps(horse_names, ensure_ascii=False, indent=4).encode('utf-8')
-            )
-        else:
-            # ローカルに保存
-            with open(horse_names_file, "w", encoding="utf-8") as f:
-                json.dump(horse_names, f, ensure_ascii=False, indent=4)
-    
-    progress_bar.progress(1.0)
-    status_text.text(f"{len(sire_results)}馬分の戦績を取得完了")
+    """産駒ごとのレース戦績を取得し保存する（引数は model.crawler.scrape_race_data を参照）"""
+    return scrape_race_data(sire_results, output_dir, on_progress=_st_progress_callback(), **kwargs)
 
 
 def scraping_and_save_data(base_url, max_pages, sire_id, use_local=False, 
-                           s3_bucket="keiba-blood-analyzer-storage", s3_prefix="data"):
+                           s3_bucket="keiba-blood-analyzer-storage", s3_prefix="data",
+                           incremental=False):
     """
     種牡馬データをスクレイピングし、ローカルまたはS3に保存する
     
@@ -187,41 +83,31 @@ def scraping_and_save_data(base_url, max_pages, sire_id, use_local=False,
         use_local: Trueの場合ローカルに保存、Falseの場合S3に保存
         s3_bucket: S3バケット名（use_local=Falseの場合必須）
         s3_prefix: S3のプレフィックス（デフォルト: "data"）
+        incremental: Trueの場合、取得済みの産駒も産駒リストの賞金・出走の列が変わっていれば
+            新しいレースだけを差分取得する
     """
     
-    if use_local:
-        output_dir = f"data/{sire_id}"
-    else:
-        if not s3_bucket:
-            st.error("S3保存時はs3_bucketパラメータが必須です")
-            return
-        output_dir = f"s3://{s3_bucket}/{s3_prefix}/{sire_id}"
-
-    # （１）種牡馬の産駒のリストをスクレイピング
-    sire_results, sire_horse_name = st_scraping_sire_data(base_url, max_pages=max_pages)
-    if sire_results != []:
-        sire_file = os.path.join(output_dir, f"{sire_id}.jsonl")
-        name_file = os.path.join(output_dir, f"{sire_horse_name}.txt")
-        
-        if use_local:
-            with open(name_file, "w") as f:
-                f.write(sire_horse_name)
-        else:
-            save_txt(sire_horse_name, name_file)
-
-        # 
-        save_jsonl(sire_results, sire_file)
-
-        # （２）産駒ごとにレース結果を取得
-        if sire_results:
-            st_scraping_race_data(sire_results, output_dir)
-        
-        if not use_local:
-            st.success(f"データをS3 ({s3_bucket}/{s3_prefix}/{sire_id}) に保存しました")
-        else:
-            st.success(f"データをローカル ({output_dir}) に保存しました")
-    else:
+    if not use_local and not s3_bucket:
+        st.error("S3保存時はs3_bucketパラメータが必須です")
+        return
+    output_dir = sire_output_dir(sire_id, use_local=use_local, s3_bucket=s3_bucket, s3_prefix=s3_prefix)
+
+    try:
+        saved = scrape_sire(
+            sire_id, output_dir, max_pages=max_pages, incremental=incremental,
+            on_sire_progress=_st_progress_callback(), on_race_progress=_st_progress_callback(),
+            log=st.info,
+        )
+    except RuntimeError as e:
+        # 産駒リストが途中までしか取得できない場合は保存しない
+        st.error(f"{e}。時間をおいて再度実行してください。")
+        return
+    if not saved:
         st.warning("産駒データが取得できませんでした。URLを確認してください。")
+    elif not use_local:
+        st.success(f"データをS3 ({s3_bucket}/{s3_prefix}/{sire_id}) に保存しました")
+    else:
+        st.success(f"データをローカル ({output_dir}) に保存しました")
 
 
 def st_hire_horse_birth_year(df_sire) -> str:
@@ -301,84 +187,124 @@ def rename_col_for_sorting(df, groupby_cols: List[str]) -> pd.DataFrame:
 
 
 
-def race_record_ratio_chart(df_race: pd.DataFrame, groupby_cols: List[str], data_min: int):
-    # 芝・ダートごとの成績を集計
-    df_race_clean = df_race.dropna(subset=["芝ダート"])
-
-    # 着順に基づいてカテゴリを作成
-    df_race_clean["1着"] = (df_race_clean["着順"] == 1).astype(int)
-    df_race_clean["2着以内"] = (df_race_clean["着順"] <= 2).astype(int)
-    df_race_clean["3着以内"] = (df_race_clean["着順"] <= 3).astype(int)
-    df_race_clean["掲示板以内"] = (df_race_clean["着順"] <= 5).astype(int)
-
-    df_race_clean["2着"] = (df_race_clean["着順"] == 2).astype(int)
-    df_race_clean["3着"] = (df_race_clean["着順"] == 3).astype(int)
-    df_race_clean["掲示板"] = df_race_clean["着順"].apply(lambda x: 4 <= x <= 5).astype(int)
-
-    # 芝・ダートと距離区分ごとに集計
-    stats = df_race_clean.groupby(groupby_cols).agg(
-        総出走数=("着順", "count"),
-        勝利数=("1着", "sum"),
-        連帯数=("2着以内", "sum"),
-        複勝数=("3着以内", "sum"),
-        掲示板内数=("掲示板以内", "sum"),
-        二着数=("2着", "sum"),
-        三着数=("3着", "sum"),
-        掲示板数=("掲示板", "sum"),
-    ).reset_index()
-
-    # 勝率、連帯率、複勝率を計算
-    stats["勝率"] = (stats["勝利数"] / stats["総出走数"] * 100).round(2)
-    stats["連帯率"] = (stats["連帯数"] / stats["総出走数"] * 100).round(2)
-    stats["複勝率"] = (stats["複勝数"] / stats["総出走数"] * 100).round(2)
-    stats["掲示板率"] = (stats["掲示板内数"] / stats["総出走数"] * 100).round(2)
-
-    stats["戦績"] = stats.apply(
-        lambda row: f"{row['勝利数']}-{row['二着数']}-{row['三着数']}-{row['掲示板数']}-{row['総出走数'] - row['掲示板内数']}",
-        axis=1
-    )
+# 着順の割合グラフの積み上げ順
+RATIO_CATEGORIES = ["1着率", "2着率", "3着率", "掲示板率", "着外率"]
+RECORD_TABLE_COLUMNS = ["勝率", "連帯率", "複勝率", "総出走数", "戦績"]
 
-    # データ数が少ない条件を除外
-    stats = stats[stats["総出走数"] >= data_min]
 
-    # ソート用に特定の列をリネーム
-    stats = rename_col_for_sorting(stats, groupby_cols)
+def race_record_table(stats: pd.DataFrame, groupby_cols: List[str], data_min: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    集計済みの成績から、表示用の表とグラフ用の縦持ちデータを作る（引数は変更しない）
 
+    Returns:
+        (groupby_cols + 勝率・連帯率・複勝率・総出走数・戦績 の表, 条件・着順カテゴリ・割合 の縦持ちデータ)
+    """
+    # データ数が少ない条件を除外
+    stats = stats[stats["総出走数"] >= data_min].copy()
 
-    # データを可視化用に整形
-    stats_viz = stats.copy()
-    stats_viz["着外数"] = stats_viz["総出走数"] - stats_viz["掲示板内数"]
+    # 戦績（1着-2着-3着-掲示板-着外）
+    unplaced = stats["総出走数"] - stats["掲示板内数"]
+    stats["戦績"] = (stats["勝利数"].astype(str) + "-" + stats["二着数"].astype(str) + "-" + stats["三着数"].astype(str)
+                   + "-" + stats["掲示板数"].astype(str) + "-" + unplaced.astype(str))
 
-    # 割合を計算
-    stats_viz["1着率"] = (stats_viz["勝利数"] / stats_viz["総出走数"] * 100).round(2)
-    stats_viz["2着率"] = (stats_viz["二着数"] / stats_viz["総出走数"] * 100).round(2)
-    stats_viz["3着率"] = (stats_viz["三着数"] / stats_viz["総出走数"] * 100).round(2)
-    stats_viz["掲示板率"] = (stats_viz["掲示板数"] / stats_viz["総出走数"] * 100).round(2)
-    stats_viz["着外率"] = (stats_viz["着外数"] / stats_viz["総出走数"] * 100).round(2)
+    # ソート用に特定の列をリネーム
+    stats = rename_col_for_sorting(stats, groupby_cols)
 
+    # 割合を計算（1着率は勝率と同じ）
+    starts = stats["総出走数"]
+    stats_viz = pd.DataFrame({
+        "1着率": stats["勝率"],
+        "2着率": (stats["二着数"] / starts * 100).round(2),
+        "3着率": (stats["三着数"] / starts * 100).round(2),
+        "掲示板率": (stats["掲示板数"] / starts * 100).round(2),
+        "着外率": (unplaced / starts * 100).round(2),
+    })
 
     # 条件名を作成
-    stats_viz["条件"] = ""
-    for col in groupby_cols:
-        stats_viz["条件"] += stats_viz[col] + "/"
-    stats_viz["条件"] = stats_viz["条件"].str.rstrip("/")
+    label = stats[groupby_cols[0]].astype(str)
+    for col in groupby_cols[1:]:
+        label = label + "/" + stats[col].astype(str)
+    stats_viz["条件"] = label.str.rstrip("/")
 
     # 縦持ちデータに変換
     stats_melted = stats_viz.melt(
         id_vars=["条件"],
-        value_vars=["1着率", "2着率", "3着率", "掲示板率", "着外率"],
+        value_vars=RATIO_CATEGORIES,
         var_name="着順カテゴリ",
         value_name="割合"
     )
+    return stats[groupby_cols + RECORD_TABLE_COLUMNS], stats_melted
+
+
+# race_record_table の結果をプロセス内の全セッションで共有するキャッシュ
+RECORD_TABLE_CACHE_SIZE = 256
+_record_table_cache: "OrderedDict[tuple, tuple[pd.DataFrame, pd.DataFrame]]" = OrderedDict()
+_record_table_cache_lock = threading.Lock()
+
+
+def cached_race_record_table(
+    cache_key: tuple,
+    groupby_cols: List[str],
+    data_min: int,
+    compute_stats: Callable[[], pd.DataFrame],
+    top_k: int | None = None,
+    page: int = 0,
+    rank_by: str = "出走数",
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    race_record_table の結果を (cache_key, groupby_cols, data_min, 上位の条件) ごとに覚えておき（LRU）、同じ条件では再計算しない
+
+    Args:
+        cache_key: 種牡馬と絞り込み条件を表すキー（例: ((種牡馬名, データのversion), filter_key)）
+        compute_stats: キャッシュにない場合に集計済みの成績を返す関数
+        top_k, page, rank_by: 指定時は rank_record_groups で上位 top_k 件の page ページ目だけを表にする
+            （ページ数は表の attrs["pages"]）
+    """
+    key = (cache_key, tuple(groupby_cols), data_min, top_k, page, rank_by)
+    with _record_table_cache_lock:
+        table = _record_table_cache.get(key)
+        if table is not None:
+            _record_table_cache.move_to_end(key)
+            return table
+    stats, pages = compute_stats(), 1
+    if top_k is not None:
+        stats, pages = rank_record_groups(stats, groupby_cols, data_min, top_k, page, rank_by)
+    table = race_record_table(stats, groupby_cols, data_min)
+    table[0].attrs["pages"] = pages
+    with _record_table_cache_lock:
+        _record_table_cache[key] = table
+        if len(_record_table_cache) > RECORD_TABLE_CACHE_SIZE:
+            _record_table_cache.popitem(last=False)
+    return table
+
+
+def race_record_ratio_chart(df_race: pd.DataFrame, groupby_cols: List[str], data_min: int,
+                            stats: pd.DataFrame | None = None,
+                            table: tuple[pd.DataFrame, pd.DataFrame] | None = None,
+                            sort_conditions: bool = True):
+    """
+    条件ごとの着順の割合を表示する
+
+    Args:
+        stats: 集計済みの成績（model.store.race_record_stats の結果など）。省略時は df_race から集計する
+        table: race_record_table の結果（cached_race_record_table で取得したものなど）。指定時は集計しない
+        sort_conditions: Falseの場合、条件を名前順に並べ替えず表の行の順（順位の順など）で表示する
+    """
+    if table is None:
+        if stats is None:
+            stats = race_record_stats(df_race, groupby_cols)
+        table = race_record_table(stats, groupby_cols, data_min)
+    stats, stats_melted = table
 
     # 着順カテゴリの順序を定義
-    category_order = ["1着率", "2着率", "3着率", "掲示板率", "着外率"]
+    category_order = RATIO_CATEGORIES
 
     chart_stack = (
         alt.Chart(stats_melted)
         .mark_bar()
         .encode(
-            y=alt.Y("条件:N", title="条件", axis=alt.Axis(labelLimit=0)),
+            y=alt.Y("条件:N", title="条件", axis=alt.Axis(labelLimit=0),
+                    sort="ascending" if sort_conditions else None),
             x=alt.X("割合:Q", title="割合 (%)", stack="normalize", axis=alt.Axis(format='%')),
             color=alt.Color(
                 "着順カテゴリ:N",
@@ -402,7 +328,7 @@ def race_record_ratio_chart(df_race: pd.DataFrame, groupby_cols: List[str], data
     st.altair_chart(chart_stack + rule, width='stretch')
 
 
-    st.dataframe(stats[groupby_cols + ["勝率", "連帯率", "複勝率", "総出走数", "戦績"]], 
+    st.dataframe(stats, 
                  hide_index=True, 
                  width='stretch',
                  column_config={
@@ -414,54 +340,129 @@ def race_record_ratio_chart(df_race: pd.DataFrame, groupby_cols: List[str], data
                  })
 
 
-def race_margin_timediff_chart(df_race: pd.DataFrame, groupby_cols: List[str], data_min: int):
-    """着差のバイオリンチャートを条件ごとに表示する関数"""
-    import plotly.express as px
-    
-    # 着差データをクリーンアップ
-    df_race_clean = df_race.dropna(subset=["芝ダート"])
-    
+def _margin_frame(df_race: pd.DataFrame, groupby_cols: List[str], group_values=None) -> pd.DataFrame:
+    """
+    着差が数値のレースだけを、条件・着差_数値 の2列にする
+
+    group_values を指定した場合、groupby_cols の先頭の列がそれ以外の値のレースは「その他」にまとめる
+    """
+    cols = [col for col in groupby_cols if col in df_race.columns]
+    df_race_clean = df_race.loc[df_race["芝ダート"].notna(), cols + ["着差"]].copy()
+    if group_values is not None:
+        key = df_race_clean[groupby_cols[0]]
+        df_race_clean[groupby_cols[0]] = key.astype(object).where(key.isin(group_values), OTHERS_LABEL)
+
     # 着差を数値に変換（必要に応じて）
-    df_race_clean.loc[:, "着差_数値"] = pd.to_numeric(df_race_clean["着差"], errors='coerce')
+    df_race_clean["着差_数値"] = pd.to_numeric(df_race_clean["着差"], errors='coerce')
     df_race_clean = df_race_clean.dropna(subset=["着差_数値"])
-    
+
     # ソート用に特定の列をリネーム
     df_race_clean = rename_col_for_sorting(df_race_clean, groupby_cols)
 
-
     # 条件名を作成
-    df_race_clean["条件"] = ""
-    for col in groupby_cols:
-        if col in df_race_clean.columns:
-            df_race_clean["条件"] += df_race_clean[col].astype(str) + "/"
-    df_race_clean["条件"] = df_race_clean["条件"].str.rstrip("/")
-    
-    # 各条件のデータ数を集計
-    condition_counts = df_race_clean.groupby("条件").size()
-    valid_conditions = condition_counts[condition_counts >= data_min].index
-    
-    # データ数が少ない条件を除外
-    df_filtered = df_race_clean[df_race_clean["条件"].isin(valid_conditions)]
-    
-    if df_filtered.empty:
+    label = pd.Series("", index=df_race_clean.index)
+    for col in cols:
+        label = label + df_race_clean[col].astype(str) + "/"
+    return pd.DataFrame({"条件": label.str.rstrip("/"), "着差_数値": df_race_clean["着差_数値"]})
+
+
+# margin_box_summary の列
+MARGIN_SUMMARY_COLUMNS = ["件数", "q1", "median", "q3", "lowerfence", "upperfence"]
+
+
+def margin_box_summary(df_race: pd.DataFrame, groupby_cols: List[str], data_min: int,
+                       group_values=None) -> pd.DataFrame:
+    """
+    条件ごとの着差の箱ひげ図の要約（件数・四分位数・ひげの端）を計算する
+
+    ひげはTukeyの方法（四分位範囲の1.5倍以内にある最も外側の値）
+    group_values を指定した場合、groupby_cols の先頭の列がそれ以外の値のレースは「その他」にまとめる
+
+    Returns:
+        条件(昇順)をインデックスとし、件数・q1・median・q3・lowerfence・upperfence の列を持つDataFrame
+        （件数が data_min 未満の条件は除く）
+    """
+    margins = _margin_frame(df_race, groupby_cols, group_values)
+    if margins.empty:
+        return pd.DataFrame(columns=MARGIN_SUMMARY_COLUMNS, index=pd.Index([], name="条件"))
+
+    grouped = margins.groupby("条件")["着差_数値"]
+    summary = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    summary.columns = ["q1", "median", "q3"]
+    summary.insert(0, "件数", grouped.size())
+
+    # 四分位範囲の1.5倍の範囲内で最も外側にある値をひげの端にする
+    iqr = summary["q3"] - summary["q1"]
+    lower_limit = margins["条件"].map(summary["q1"] - 1.5 * iqr)
+    upper_limit = margins["条件"].map(summary["q3"] + 1.5 * iqr)
+    values = margins["着差_数値"]
+    summary["lowerfence"] = values.where(values >= lower_limit).groupby(margins["条件"]).min().reindex(summary.index)
+    summary["upperfence"] = values.where(values <= upper_limit).groupby(margins["条件"]).max().reindex(summary.index)
+    return summary[summary["件数"] >= data_min].sort_index()
+
+
+def race_margin_timediff_chart(df_race: pd.DataFrame, groupby_cols: List[str], data_min: int,
+                               show_points: bool = False, group_values=None):
+    """
+    着差の箱ひげ図を条件ごとに表示する関数
+
+    四分位数・ひげはサーバー側で条件ごとに計算し、要約だけを描画する（レース数によらずデータ量は一定）
+
+    Args:
+        show_points: Trueの場合、全レースの着差をブラウザに送り、plotly側で箱ひげ図を計算する（外れ値の点も表示する）
+        group_values: groupby_cols の先頭の列（騎手など）のうち表示する値（model.analysis.rank_group_values の結果）。
+            指定した場合はこの順に上から並べ、それ以外の値は「その他」にまとめて最後に表示する
+    """
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    if show_points:
+        df_filtered = _margin_frame(df_race, groupby_cols, group_values)
+        # 各条件のデータ数を集計し、データ数が少ない条件を除外
+        condition_counts = df_filtered.groupby("条件").size()
+        df_filtered = df_filtered[df_filtered["条件"].isin(condition_counts[condition_counts >= data_min].index)]
+        conditions = sorted(df_filtered["条件"].unique())
+    else:
+        summary = margin_box_summary(df_race, groupby_cols, data_min, group_values)
+        conditions = list(summary.index)
+
+    if not conditions:
         st.warning(f"データ数が{data_min}以上の条件がありません。")
         return
-    
-    # 条件列を50音順にソート
-    df_filtered = df_filtered.sort_values("条件")
-    
-    # 箱ひげ図
-    fig = px.box(
-        df_filtered,
-        y="条件",
-        x="着差_数値",
-        color="条件",
-        # title="条件別着差の分布",
-        labels={"着差_数値": "着差", "条件": "条件"},
-        orientation="h",
-        height=600,
-        category_orders={"条件": sorted(df_filtered["条件"].unique())}
-    )
+
+    if group_values is not None:
+        # 先頭の列の順位の順に上から並べる（plotlyの横向きのカテゴリ軸は先頭が下になるため逆順にする）
+        rank = {str(value): i for i, value in enumerate(group_values)}
+        conditions = sorted(conditions, key=lambda c: (rank.get(c.split("/")[0], len(rank)), c), reverse=True)
+
+    if show_points:
+        # 条件列を50音順にソート
+        fig = px.box(
+            df_filtered.sort_values("条件"),
+            y="条件",
+            x="着差_数値",
+            color="条件",
+            labels={"着差_数値": "着差", "条件": "条件"},
+            orientation="h",
+            height=600,
+            category_orders={"条件": conditions}
+        )
+    else:
+        # 条件ごとに色を分けるため、1条件1トレースで要約値だけを渡す
+        fig = go.Figure([
+            go.Box(
+                y=[row.Index], name=row.Index, orientation="h",
+                q1=[row.q1], median=[row.median], q3=[row.q3],
+                lowerfence=[row.lowerfence], upperfence=[row.upperfence],
+            )
+            for row in summary.itertuples()
+        ])
+        fig.update_layout(
+            height=600,
+            xaxis_title="着差",
+            yaxis_title="条件",
+            yaxis=dict(categoryorder="array", categoryarray=conditions),
+        )
     fig.update_xaxes(range=[-2, 3])
     fig.update_layout(
         showlegend=False,
@@ -472,4 +473,4 @@ def race_margin_timediff_chart(df_race: pd.DataFrame, groupby_cols: List[str], d
     fig.update_yaxes(fixedrange=True)
     fig.add_vline(x=0, line_dash="dash", line_color="gray")
     
-    st.plotly_chart(fig, width='stretch', config={'displayModeBar': False})
\ No newline at end of file
+    st.plotly_chart(fig, width='stretch', config={'displayModeBar': False})
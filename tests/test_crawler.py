@@ -0,0 +1,42 @@
+import model.scraping as scraping
+from model.crawler import _fetch_sire_page, _sire_list_url
+from model.scraping import RateLimiter
+
+BAD_PAGE = "<html><body>アクセスが集中しています</body></html>".encode("euc-jp")
+GOOD_PAGE = "<html><head><title>産駒一覧</title></head><body></body></html>".encode("euc-jp")
+
+
+class FakeResponse:
+    def __init__(self, content: bytes):
+        self.status_code = 200
+        self.content = content
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """get() のたびに contents を先頭から順に返す"""
+
+    def __init__(self, contents):
+        self.contents = list(contents)
+        self.urls = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.urls.append(url)
+        return FakeResponse(self.contents.pop(0))
+
+
+def test_fetch_sire_page_refetches_bad_cached_response(tmp_path, monkeypatch):
+    session = FakeSession([BAD_PAGE, GOOD_PAGE])
+    monkeypatch.setattr(scraping, "get_session", lambda: session)
+    monkeypatch.setattr(scraping.default_html_cache, "cache_dir", tmp_path)
+
+    soup = _fetch_sire_page("000a00033a", 2, RateLimiter(rate=1000, capacity=1000), "bs4")
+
+    # 1回目の応答はキャッシュされるが、取り直しではキャッシュを読まずにサイトから取得する
+    assert soup is not None
+    assert session.urls == [_sire_list_url("000a00033a", 2)] * 2
+    content, _ = scraping.default_html_cache.get(_sire_list_url("000a00033a", 2))
+    assert content == GOOD_PAGE